@@ -0,0 +1,75 @@
+"""
+Time saving the contexts and embeddings of a chunking checkpoint, the write save_results does.
+
+    python -m benchmarks.chunk_writes [--chunks N] [--runs N]
+
+Three ways of writing the same rows:
+- per row flush: load the chunk, set its columns and flush, one round trip per chunk. What the worker used to do.
+- executemany: one bulk UPDATE by primary key (update_many), every vector is bound as a text literal.
+- copy: a binary COPY into a temp table and a single UPDATE ... FROM (save_results).
+
+~90 chunks is a 70KB earnings call. Everything runs in a transaction that is rolled back, nothing is persisted.
+Exits non-zero when the COPY is not the fastest.
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+import numpy as np
+
+from src.ai.models import EMBED_DIM
+from src.db.engine import AsyncUnitOfWork, init_db
+from src.db.models import DocumentChunk
+from src.db.repositories import AsyncDocumentChunkRepository
+from src.services.schema import DocumentCreate
+
+async def per_row_flush(repo: AsyncDocumentChunkRepository, values: list[dict]):
+    for value in values:
+        db_chunk = await repo.session.get(DocumentChunk, value["id"])
+        db_chunk.context = value["context"]
+        db_chunk.embedding = value["embedding"]
+        await repo.session.flush()
+
+WRITES = {
+    "per row flush": per_row_flush,
+    "executemany": AsyncDocumentChunkRepository.update_many,
+    "copy": AsyncDocumentChunkRepository.save_results,
+}
+
+async def run(save, n_chunks: int) -> float:
+    rng = np.random.default_rng()
+    results = [dict(context = "context " * 20, embedding = rng.standard_normal(EMBED_DIM, dtype=np.float32)) for _ in range(n_chunks)]
+
+    async with AsyncUnitOfWork() as uow:
+        document = await uow.documents.create(DocumentCreate(title = "benchmark", content = "benchmark"))
+        await uow.chunks.create_pending(document.id, {i: "chunk " * 170 for i in range(n_chunks)})
+        rows = await uow.chunks.get_progress(document.id)
+        values = [{"id": row.id, **it} for row, it in zip(rows, results)]
+
+        start = time.perf_counter()
+        await save(uow.chunks, values)
+        elapsed = time.perf_counter() - start
+
+        await uow.session.rollback()
+        return elapsed
+
+async def main(n_chunks: int, n_runs: int) -> bool:
+    medians = {}
+    for name, save in WRITES.items():
+        timings = sorted([await run(save, n_chunks) for _ in range(n_runs)])
+        medians[name] = timings[len(timings) // 2]
+        print(f"{name:>14}: {n_chunks} chunks, median {medians[name] * 1000:.1f}ms, best {timings[0] * 1000:.1f}ms")
+
+    fastest = min(medians, key = medians.get)
+    print(f"fastest: {fastest}, {medians['per row flush'] / medians['copy']:.1f}x faster than per row flush")
+    return fastest == "copy"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Compare the ways of writing chunk contexts and embeddings.")
+    parser.add_argument("--chunks", type = int, default = 90, help = "Chunks written per run.")
+    parser.add_argument("--runs", type = int, default = 5, help = "Runs per write, the median is compared.")
+    args = parser.parse_args()
+
+    init_db()
+    sys.exit(0 if asyncio.run(main(args.chunks, args.runs)) else 1)
@@ -0,0 +1,42 @@
+"""
+Compare the chunking strategies on every document in resources/.
+
+    python -m benchmarks.chunking_strategies
+
+Per document and strategy: chunk count, chunking time, token spread per chunk and hydration tokens (one MINI call per
+chunk, each resending the full document as instructions). No db or OpenAI key needed.
+"""
+from pathlib import Path
+import statistics
+import time
+
+from src.ai.processing import detect_chunking_strategy, get_chunker, get_encoding
+from src.ai.prompts import get_chunk_prompt_input, get_chunk_prompt_instructions
+
+RESOURCES = Path(__file__).parents[1] / "resources"
+
+def main():
+    encoding = get_encoding()
+
+    for path in sorted(RESOURCES.glob("*.txt")):
+        text = path.read_text()
+        detected = detect_chunking_strategy(text)
+        n_tokens_instructions = len(encoding.encode_ordinary(get_chunk_prompt_instructions(text)))
+
+        print(f"----------{path.name}: {len(encoding.encode_ordinary(text))} tokens, detected {detected}----------")
+
+        for name in dict.fromkeys(["naive", "token", detected]):
+            start = time.perf_counter()
+            chunks = list(get_chunker(name)(text))
+            elapsed = time.perf_counter() - start
+
+            sizes = [len(encoding.encode_ordinary(it)) for it in chunks]
+            hydration_tokens = sum(n_tokens_instructions + len(encoding.encode_ordinary(get_chunk_prompt_input(it))) for it in chunks)
+            print(
+                f"{name:>8}: {len(chunks):>3} chunks in {elapsed * 1000:6.1f}ms, "
+                f"tokens/chunk min {min(sizes)} / mean {statistics.mean(sizes):.0f} / max {max(sizes)} / stdev {statistics.pstdev(sizes):.1f}, "
+                f"hydration tokens {hydration_tokens}"
+            )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Check that the planner picks the hnsw index for the indexed similarity search on a production sized table, seq scans left on.
+
+    python -m benchmarks.similarity_plans [--chunks N]
+
+`--chunks` synthetic chunks (default 1M) with random embeddings are generated and analyzed. The hnsw index is dropped during
+the load and rebuilt after, a bulk build is much faster than indexing row by row. Everything runs in a transaction that is
+rolled back, but it takes a while and locks document_chunks meanwhile: run it against a dev database, never production.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+from sqlalchemy import text
+
+from src.ai.models import EMBED_DIM
+from src.db.engine import UnitOfWork, init_db
+from src.db.models import DocumentChunk
+from src.services.schema import DocumentCreate, SimilaritySearchMode
+
+HNSW_INDEX = "ix_documents_embedding_hnsw_cos"
+
+def main(n_chunks: int) -> bool:
+    rng = np.random.default_rng()
+    embeddings = [rng.standard_normal(EMBED_DIM, dtype=np.float32) for _ in range(5)]
+    hnsw_index = next(it for it in DocumentChunk.__table__.indexes if it.name == HNSW_INDEX)
+
+    with UnitOfWork() as uow:
+        document = uow.documents.create(DocumentCreate(title = "plans", content = "plans"))
+        conn = uow.session.connection()
+
+        start = time.perf_counter()
+        hnsw_index.drop(conn)
+        conn.execute(
+            text("""
+                INSERT INTO document_chunks (document_id, position, chunk, embedding)
+                SELECT :document_id, i, 'synthetic chunk ' || i,
+                    -- referencing i keeps the subquery from being evaluated once for every row
+                    (SELECT array_agg(random() - 0.5)::vector FROM generate_series(1, :dim) WHERE i > 0)
+                FROM generate_series(1, :n_chunks) AS i
+            """),
+            {"document_id": document.id, "dim": EMBED_DIM, "n_chunks": n_chunks},
+        )
+        print(f"generated {n_chunks} chunks in {time.perf_counter() - start:.0f}s")
+
+        start = time.perf_counter()
+        conn.execute(text("SET LOCAL maintenance_work_mem = '1GB'"))
+        hnsw_index.create(conn)
+        conn.execute(text("ANALYZE document_chunks"))
+        print(f"built the hnsw index in {time.perf_counter() - start:.0f}s")
+
+        plans = {mode: uow.chunks.explain_similarities(embeddings, mode = mode) for mode in SimilaritySearchMode}
+        uow.session.rollback()
+
+    for mode, plan in plans.items():
+        print(f"----------{mode.value}----------")
+        print("\n".join(plan))
+
+    uses_index = any(f"Index Scan using {HNSW_INDEX}" in line for line in plans[SimilaritySearchMode.INDEXED])
+    print(f"indexed search uses {HNSW_INDEX}: {uses_index}")
+    return uses_index
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "EXPLAIN the similarity search on a generated table.")
+    parser.add_argument("--chunks", type = int, default = 1_000_000, help = "Synthetic chunks to generate.")
+    args = parser.parse_args()
+
+    init_db()
+    sys.exit(0 if main(args.chunks) else 1)
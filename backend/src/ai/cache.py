@@ -0,0 +1,195 @@
+"""
+Content addressed caches for LLM responses and embeddings.
+
+The response key is a hash of everything that determines a response (model, instructions, input, output schema, sampling parameters),
+so re-sending the same note is served without a call. Responses sampled with a temperature are only cached when the caller opts in.
+Embeddings are keyed by model and normalized text.
+"""
+from collections import OrderedDict
+import hashlib
+import json
+from typing import Any, Type
+
+import numpy as np
+from pydantic import BaseModel
+from sqlalchemy.exc import SQLAlchemyError
+
+from src.ai.models import Models
+from src.ai.processing import normalize_text
+from src.db.engine import AsyncUnitOfWork
+from src.env import settings
+from src._logging import get_logger
+
+logger = get_logger(__name__)
+
+EVICT_EVERY = 2**6      # writes to the persistent tier between two eviction passes
+
+def get_embedding_cache_key(model: Models, text: str) -> str:
+    """
+    Hash of the model and the normalized text. Texts that only differ in whitespace or case share an embedding.
+    """
+    return hashlib.sha256(f"{model.value}\0{normalize_text(text)}".encode()).hexdigest()
+
+def get_cache_key(model: Models, instructions: str | None, input: str, structured_output: Type[BaseModel] | None, **params: Any) -> str:
+    """
+    Hash of the request. `params` are the sampling and other request parameters sent to the api.
+    """
+    payload = {
+        "model": model.value,
+        "instructions": instructions,
+        "input": input,
+        "schema": structured_output.model_json_schema() if structured_output is not None else None,
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+class ResponseCache:
+    """
+    Two tier response cache.
+
+    - an in process LRU of `maxsize` payloads.
+    - optionally the response_cache table, shared by every process. Entries expire after `ttl` seconds and the table is
+      trimmed to `max_entries` rows, least recently used first. Db errors are logged and treated as a miss.
+
+    Payloads are strings: the output text, or the json of the structured output.
+    """
+
+    def __init__(self, maxsize: int, persistent: bool = False, ttl: float = 0, max_entries: int = 0):
+        self.maxsize = maxsize
+        self.persistent = persistent
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self._cache: OrderedDict[str, str] = OrderedDict()
+        self._writes = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0
+
+    def _put_local(self, key: str, payload: str) -> None:
+        self._cache[key] = payload
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    async def get(self, key: str) -> str | None:
+        payload = self._cache.get(key)
+        if payload is not None:
+            self._cache.move_to_end(key)
+            return payload
+
+        if not self.persistent:
+            return None
+
+        try:
+            async with AsyncUnitOfWork() as uow:
+                payload = await uow.response_cache.get(key, self.ttl)
+        except SQLAlchemyError as ex:
+            logger.warning(f"response cache read failed: {ex}")
+            return None
+
+        if payload is not None:
+            self._put_local(key, payload)
+        return payload
+
+    async def put(self, key: str, model: Models, payload: str) -> None:
+        self._put_local(key, payload)
+
+        if not self.persistent:
+            return
+
+        self._writes += 1
+        try:
+            async with AsyncUnitOfWork() as uow:
+                await uow.response_cache.put(key, model.value, payload)
+                if self._writes % EVICT_EVERY == 0:
+                    evicted = await uow.response_cache.evict(self.ttl, self.max_entries)
+                    logger.debug(f"response cache evicted {evicted} entries")
+        except SQLAlchemyError as ex:
+            logger.warning(f"response cache write failed: {ex}")
+
+    def clear(self) -> None:
+        """
+        Drop the in process tier.
+        """
+        self._cache.clear()
+
+class EmbeddingCache:
+    """
+    Two tier embedding cache, same layout as ResponseCache: an in process LRU optionally backed by the embedding_cache table.
+    Embeddings are deterministic so entries do not expire.
+    """
+
+    def __init__(self, maxsize: int, persistent: bool = False):
+        self.maxsize = maxsize
+        self.persistent = persistent
+
+        self._cache: OrderedDict[str, np.ndarray] = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0
+
+    def _put_local(self, key: str, embedding: np.ndarray) -> None:
+        self._cache[key] = embedding
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    async def get_many(self, keys: list[str]) -> dict[str, np.ndarray]:
+        """
+        Returns the cached embeddings of the given keys, missing keys are left out.
+        """
+        found: dict[str, np.ndarray] = {}
+        for key in keys:
+            embedding = self._cache.get(key)
+            if embedding is not None:
+                self._cache.move_to_end(key)
+                found[key] = embedding
+
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if not missing or not self.persistent:
+            return found
+
+        try:
+            async with AsyncUnitOfWork() as uow:
+                stored = await uow.embedding_cache.get_many(missing)
+        except SQLAlchemyError as ex:
+            logger.warning(f"embedding cache read failed: {ex}")
+            return found
+
+        for key, embedding in stored.items():
+            self._put_local(key, embedding)
+        return found | stored
+
+    async def put_many(self, model: Models, embeddings: dict[str, np.ndarray]) -> None:
+        for key, embedding in embeddings.items():
+            self._put_local(key, embedding)
+
+        if not self.persistent:
+            return
+
+        try:
+            async with AsyncUnitOfWork() as uow:
+                await uow.embedding_cache.put_many(model.value, embeddings)
+        except SQLAlchemyError as ex:
+            logger.warning(f"embedding cache write failed: {ex}")
+
+    def clear(self) -> None:
+        """
+        Drop the in process tier.
+        """
+        self._cache.clear()
+
+response_cache = ResponseCache(
+    settings.RESPONSE_CACHE_SIZE,
+    persistent = settings.RESPONSE_CACHE_BACKEND == "postgres",
+    ttl = settings.RESPONSE_CACHE_TTL_SECONDS,
+    max_entries = settings.RESPONSE_CACHE_MAX_ENTRIES,
+)
+
+embedding_cache = EmbeddingCache(
+    settings.EMBEDDING_CACHE_SIZE,
+    persistent = settings.EMBEDDING_CACHE_BACKEND == "postgres",
+)
@@ -1,17 +1,109 @@
+import asyncio
+import base64
 from enum import Enum
+import json
 import math
-from typing import Type, TypeVar, overload
-from openai import AsyncOpenAI, OpenAI
+import re
+from typing import AsyncIterator, Type, TypeVar, overload
+import httpx
+import numpy as np
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, OpenAI
 from openai.types import Embedding
 from pydantic import BaseModel
 
-from src.ai.models import Models
-from src.ai.processing import get_token_count
-from src.ai.rate_limiter import request_access
+from src.ai.cache import embedding_cache, get_cache_key, get_embedding_cache_key, response_cache
+from src.ai.models import EXPECTED_OUTPUT_TOKENS, Models
+from src.ai.processing import get_token_counts
+from src.ai.rate_limiter import LogItem, Priority, report_capacity, report_rate_limited, request_access, settle_access
+from src.ai.usage import record_usage
 from src.env import settings
+from src.utils import retry
+from src._logging import get_logger
 
-client = OpenAI(api_key = settings.OPENAI_API_KEY)
-async_client = AsyncOpenAI(api_key = settings.OPENAI_API_KEY)
+logger = get_logger(__name__)
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": .001, "s": 1, "m": 60, "h": 3600}
+
+def _parse_duration(value: str | None) -> float | None:
+    """
+    Parse the reset format used by the x-ratelimit-reset-* headers, e.g. "20ms", "1s", "6m0s", "1h2m3.5s".
+    """
+    if not value:
+        return None
+
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+def _parse_int(value: str | None) -> int | None:
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+def _get_request_model(request: httpx.Request) -> Models | None:
+    try:
+        return Models(json.loads(request.content).get("model"))
+    except (ValueError, AttributeError):
+        return None
+
+def _get_retry_after(headers: httpx.Headers) -> float:
+    """
+    How long the server wants us to back off after a 429. Falls back on the reset headers, then on 1s.
+    """
+    if (retry_after_ms := _parse_int(headers.get("retry-after-ms"))) is not None:
+        return retry_after_ms / 1000
+
+    if (retry_after := _parse_duration(headers.get("retry-after"))) is not None:
+        return retry_after
+
+    if (retry_after := _parse_int(headers.get("retry-after"))) is not None:
+        return retry_after
+
+    resets = [
+        _parse_duration(headers.get("x-ratelimit-reset-tokens")),
+        _parse_duration(headers.get("x-ratelimit-reset-requests")),
+    ]
+    return max((it for it in resets if it is not None), default = 1)
+
+async def _on_response(response: httpx.Response) -> None:
+    """
+    httpx hook, sees every response including the ones the sdk retries internally.
+    Feeds the x-ratelimit-* headers and 429s back into the rate limiter so it tracks the real org limits.
+    Errors are only logged, the limiter falling behind must not fail the request itself.
+    """
+    try:
+        model = _get_request_model(response.request)
+        if model is None:
+            return
+
+        if response.status_code == 429:
+            await report_rate_limited(model, _get_retry_after(response.headers))
+            return
+
+        headers = response.headers
+        if not any(key.startswith("x-ratelimit-") for key in headers.keys()):
+            return
+
+        await report_capacity(
+            model,
+            limit_tokens = _parse_int(headers.get("x-ratelimit-limit-tokens")),
+            remaining_tokens = _parse_int(headers.get("x-ratelimit-remaining-tokens")),
+            limit_requests = _parse_int(headers.get("x-ratelimit-limit-requests")),
+            remaining_requests = _parse_int(headers.get("x-ratelimit-remaining-requests")),
+        )
+    except Exception as ex:
+        logger.warning(f"Failed feeding the rate limit headers back into the rate limiter: {ex}")
+
+client = OpenAI(api_key = settings.OPENAI_API_KEY, base_url = settings.OPENAI_BASE_URL)
+async_client = AsyncOpenAI(
+    api_key = settings.OPENAI_API_KEY,
+    base_url = settings.OPENAI_BASE_URL,
+    http_client = DefaultAsyncHttpxClient(event_hooks = {"response": [_on_response]}),
+)
 
 class OpenAIError(Exception):
     """
@@ -22,78 +114,288 @@ class OpenAIError(Exception):
         self.code = code
         self.message = message
 
+async def _settle_usage(reservation: LogItem, usage, model: Models) -> None:
+    """
+    Swap the rate limiter estimate for what OpenAI actually billed.
+    """
+    if usage is not None:
+        await settle_access(reservation, usage.total_tokens, model)
+
 @overload
-async def get_response(*, input: str, instructions: str | None = None, model = Models.FULL) -> str:
+async def get_response(*, input: str, instructions: str | None = None, model = Models.FULL, priority: Priority = Priority.INTERACTIVE, temperature: float = .5, cache: bool = True, cache_sampled: bool = False) -> str:
     pass
 
 StructuredOutputType = TypeVar("StructuredOutputType", bound= BaseModel)
 @overload
-async def get_response(*, input: str, instructions: str | None = None, model = Models.FULL, structured_output: Type[StructuredOutputType]) -> StructuredOutputType:
+async def get_response(*, input: str, instructions: str | None = None, model = Models.FULL, structured_output: Type[StructuredOutputType], priority: Priority = Priority.INTERACTIVE, temperature: float = .5, cache: bool = True, cache_sampled: bool = False) -> StructuredOutputType:
     pass
 
-async def get_response(*, input: str, instructions: str | None = None, model = Models.FULL, structured_output: Type[StructuredOutputType] | None = None, timeout=20, **kwargs) -> Type[StructuredOutputType] | str:
+async def get_response(*, input: str, instructions: str | None = None, model = Models.FULL, structured_output: Type[StructuredOutputType] | None = None, priority: Priority = Priority.INTERACTIVE, temperature: float = .5, cache: bool = True, cache_sampled: bool = False, timeout=20, **kwargs) -> Type[StructuredOutputType] | str:
     """
     Get a response from the OpenAI API using the provided prompt and instructions.
+    `priority` is the rate limiter lane the call waits in.
+
+    Responses are served from the response cache when possible. `cache = False` bypasses it (no read, no write). 
+    Sampled responses (temperature > 0) are only cached with `cache_sampled = True`, for callers fine with getting the same sample back.
     
     Raises OpenAIError if the API returns an error.
     """
-    n_tokens_input = get_token_count(input)
-    n_tokens_instructions = get_token_count(instructions)
+    cache_key = None
+    if cache and response_cache.enabled and (temperature == 0 or cache_sampled):
+        cache_key = get_cache_key(model, instructions, input, structured_output, temperature = temperature, **kwargs)
+        payload = await response_cache.get(cache_key)
+        if payload is not None:
+            return structured_output.model_validate_json(payload) if structured_output is not None else payload
+
+    n_tokens_input, n_tokens_instructions = await get_token_counts([input, instructions])
+    n_tokens_output = kwargs.get("max_output_tokens") or EXPECTED_OUTPUT_TOKENS[model]
 
-    await request_access( n_tokens_input + n_tokens_instructions )
+    reservation = await request_access( n_tokens_input + n_tokens_instructions + n_tokens_output, model, priority )
 
     if structured_output is not None:
         response = await async_client.responses.parse(
             model= model.value,
-            temperature =.5,
+            temperature = temperature,
             input = input,
             instructions = instructions,
             timeout=timeout,
             text_format=structured_output,
             **kwargs
         )
+        await _settle_usage(reservation, response.usage, model)
+        record_usage(model, response.usage)
 
         if response.error is not None:
             raise OpenAIError(response.error.code, response.error.message)
         
         out: StructuredOutputType = response.output_parsed
+        if cache_key is not None and out is not None:
+            await response_cache.put(cache_key, model, out.model_dump_json())
         return out
     
     else:
         response = await async_client.responses.create(
             model= model.value,
-            temperature =.5,
+            temperature = temperature,
             input = input,
             instructions = instructions,
             timeout=timeout,
             **kwargs
         )
+        await _settle_usage(reservation, response.usage, model)
+        record_usage(model, response.usage)
 
         if response.error is not None:
             raise OpenAIError(response.error.code, response.error.message)
         
+        if cache_key is not None:
+            await response_cache.put(cache_key, model, response.output_text)
         return response.output_text
 
 
 
-async def get_embeddings(batch_text: str | list[str]) -> list[Embedding] | list[list[Embedding]]:
+async def stream_response(*, input: str, instructions: str | None = None, model = Models.FULL, priority: Priority = Priority.INTERACTIVE, temperature: float = .5, cache: bool = True, cache_sampled: bool = False, timeout=60, **kwargs) -> AsyncIterator[str]:
     """
-    Get an embedding for the given text using the OpenAI API.
-    supports batching. 
+    Streaming get_response for plain text output. Yields the output text deltas as they arrive.
+    Caching follows get_response, a cached response is yielded in one piece.
 
-    TODO: look up the max size of a batch
+    Raises OpenAIError if the API reports an error, possibly after some deltas were yielded.
     """
-    if isinstance(batch_text, str):
-        batch_text = [batch_text]
+    cache_key = None
+    if cache and response_cache.enabled and (temperature == 0 or cache_sampled):
+        cache_key = get_cache_key(model, instructions, input, None, temperature = temperature, **kwargs)
+        payload = await response_cache.get(cache_key)
+        if payload is not None:
+            yield payload
+            return
 
-    tokens = sum(get_token_count(it) for it in batch_text)
-    tokens = int(tokens)
-    await request_access(tokens)
+    n_tokens_input, n_tokens_instructions = await get_token_counts([input, instructions])
+    n_tokens_output = kwargs.get("max_output_tokens") or EXPECTED_OUTPUT_TOKENS[model]
+
+    reservation = await request_access( n_tokens_input + n_tokens_instructions + n_tokens_output, model, priority )
+
+    stream = await async_client.responses.create(
+        model= model.value,
+        temperature = temperature,
+        input = input,
+        instructions = instructions,
+        timeout=timeout,
+        stream=True,
+        **kwargs
+    )
+
+    parts: list[str] = []
+    completed = False
+    async with stream:
+        async for event in stream:
+            if event.type == "response.output_text.delta":
+                parts.append(event.delta)
+                yield event.delta
+
+            elif event.type == "response.completed":
+                completed = True
+                await _settle_usage(reservation, event.response.usage, model)
+                record_usage(model, event.response.usage)
+
+            elif event.type == "response.failed":
+                error = event.response.error
+                raise OpenAIError(error.code if error else "failed", error.message if error else "response failed")
+
+            elif event.type == "error":
+                raise OpenAIError(event.code, event.message)
+
+    if cache_key is not None and completed:
+        await response_cache.put(cache_key, model, "".join(parts))
+
+def _split_embedding_batch(n_tokens: list[int], max_inputs: int, max_tokens: int) -> list[range]:
+    """
+    Split a batch into consecutive sub-batches of at most `max_inputs` texts and `max_tokens` tokens.
+    A text over the token budget on its own gets a sub-batch to itself.
+    """
+    batches: list[range] = []
+    start, tokens = 0, 0
+
+    for i, count in enumerate(n_tokens):
+        if i > start and (i - start >= max_inputs or tokens + count > max_tokens):
+            batches.append(range(start, i))
+            start, tokens = i, 0
+        tokens += count
+
+    if start < len(n_tokens):
+        batches.append(range(start, len(n_tokens)))
+    return batches
+
+@retry
+async def _create_embeddings(batch_text: list[str], n_tokens: int, priority: Priority) -> list[np.ndarray]:
+    """
+    One embeddings api call. Retried on its own so a failed sub-batch does not redo the others.
+    Embeddings are requested base64 encoded and decoded straight into float32 arrays, no python float lists are built.
+    """
+    reservation = await request_access(n_tokens, Models.EMBEDDING, priority)
 
     response = await async_client.embeddings.create(
         model=Models.EMBEDDING.value,
-        input=batch_text
+        input=batch_text,
+        encoding_format="base64",
     )
+    await _settle_usage(reservation, response.usage, Models.EMBEDDING)
 
     # TODO: error handling (there is no error field like there is in response)    
-    return [it.embedding for it in response.data]
\ No newline at end of file
+    return [np.frombuffer(base64.b64decode(it.embedding), dtype=np.float32) for it in response.data]
+
+async def _embed(batch_text: list[str], priority: Priority) -> list[np.ndarray]:
+    """
+    Embed any number of texts. The batch is split to fit the per request input and token caps,
+    the sub-batches run concurrently under the rate limiter and the results are put back in order.
+    """
+    n_tokens = await get_token_counts(batch_text)
+    batches = _split_embedding_batch(n_tokens, settings.EMBEDDING_BATCH_MAX_INPUTS, settings.EMBEDDING_BATCH_MAX_TOKENS)
+
+    results = await asyncio.gather(*[
+        _create_embeddings(batch_text[it.start : it.stop], sum(n_tokens[it.start : it.stop]), priority)
+        for it in batches
+    ])
+    return [embedding for result in results for embedding in result]
+
+class EmbeddingCoalescer:
+    """
+    Micro-batching in front of _embed. Requests arriving within `window` seconds of each other (per priority) are merged
+    into one call, and each caller gets its own vectors back. Under load this trades a few ms of latency for far fewer
+    requests against the per minute request limit. A window of 0 disables coalescing.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+
+        self._pending: dict[Priority, list[tuple[list[str], asyncio.Future]]] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    async def embed(self, batch_text: list[str], priority: Priority) -> list[np.ndarray]:
+        if self.window <= 0:
+            return await _embed(batch_text, priority)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        pending = self._pending.get(priority)
+        if pending is None:
+            pending = self._pending[priority] = []
+            loop.call_later(self.window, self._flush, priority)
+
+        pending.append((batch_text, future))
+        return await future
+
+    def _flush(self, priority: Priority) -> None:
+        pending = self._pending.pop(priority, [])
+        if not pending:
+            return
+
+        # keep a reference, the loop only holds weak ones
+        task = asyncio.create_task(self._run(pending, priority))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, pending: list[tuple[list[str], asyncio.Future]], priority: Priority) -> None:
+        texts = list(dict.fromkeys(text for batch_text, _ in pending for text in batch_text))
+        logger.debug(f"coalesced {len(pending)} embedding requests into {len(texts)} texts")
+
+        try:
+            embeddings = dict(zip(texts, await _embed(texts, priority)))
+        except Exception as ex:
+            if len(pending) == 1:
+                _, future = pending[0]
+                if not future.done():
+                    future.set_exception(ex)
+                return
+
+            # one bad input fails the merged call for everyone, retry each caller on its own so only the faulty one gets the error
+            logger.warning(f"coalesced embedding request failed, retrying its {len(pending)} callers separately: {ex}")
+            await asyncio.gather(*[self._run_alone(batch_text, future, priority) for batch_text, future in pending])
+            return
+
+        for batch_text, future in pending:
+            if not future.done():
+                future.set_result([embeddings[it] for it in batch_text])
+
+    async def _run_alone(self, batch_text: list[str], future: asyncio.Future, priority: Priority) -> None:
+        try:
+            embeddings = await _embed(batch_text, priority)
+        except Exception as ex:
+            if not future.done():
+                future.set_exception(ex)
+            return
+
+        if not future.done():
+            future.set_result(embeddings)
+
+embedding_coalescer = EmbeddingCoalescer(settings.EMBEDDING_COALESCE_WINDOW_MS / 1000)
+
+async def get_embeddings(batch_text: str | list[str], priority: Priority = Priority.INTERACTIVE, cache: bool = True) -> list[np.ndarray]:
+    """
+    Get an embedding for the given text using the OpenAI API.
+    supports batching of any size, see _embed. Concurrent calls are merged by the embedding_coalescer.
+
+    Embeddings are served from the embedding cache when possible (`cache = False` bypasses it). The remaining texts are
+    deduplicated so each distinct text is embedded once, and the results are scattered back to every position it appeared at.
+    Positions holding the same text share the same (read only) array.
+    """
+    if isinstance(batch_text, str):
+        batch_text = [batch_text]
+
+    use_cache = cache and embedding_cache.enabled
+    keys = [get_embedding_cache_key(Models.EMBEDDING, it) for it in batch_text]
+    embeddings = await embedding_cache.get_many(keys) if use_cache else {}
+
+    # first text seen per key is the one sent
+    missing: dict[str, str] = {}
+    for key, text in zip(keys, batch_text):
+        if key not in embeddings and key not in missing:
+            missing[key] = text
+
+    if missing:
+        created = dict(zip(missing, await embedding_coalescer.embed(list(missing.values()), priority)))
+        if use_cache:
+            await embedding_cache.put_many(Models.EMBEDDING, created)
+        embeddings.update(created)
+
+    return [embeddings[key] for key in keys]
@@ -7,4 +7,13 @@ class Models(Enum):
     FULL = "gpt-4.1"
     MINI = "gpt-4.1-mini"
     EMBEDDING = "text-embedding-3-small"
-    LEGACY = "gpt-4o"   
\ No newline at end of file
+    LEGACY = "gpt-4o"
+
+# what we expect a call to produce when the caller does not set max_output_tokens. 
+# only used to size the rate limiter reservation, which is settled against the real usage after the call.
+EXPECTED_OUTPUT_TOKENS: dict[Models, int] = {
+    Models.FULL: 1024,
+    Models.MINI: 512,
+    Models.EMBEDDING: 0,
+    Models.LEGACY: 1024,
+}
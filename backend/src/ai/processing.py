@@ -1,8 +1,24 @@
-from typing import Generator
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import cache
+import hashlib
+import math
+import multiprocessing
+import re
+from typing import Any, Callable, Generator, Iterable, Iterator
 
 import tiktoken
 
 from src.ai.models import Models
+from src.env import settings
+
+ENCODING_NAME = "o200k_base"
+TOKEN_MARGIN = 1.1                  # slight margin of error on counts used for rate limiting
+TOKEN_COUNT_CACHE_SIZE = 2**12      # number of memoized counts
+OFFLOAD_MIN_CHARS = 2**14           # encode in a worker thread once a batch of misses is at least this long
+CHUNK_TOKENS = 400
+CHUNK_OVERLAP_TOKENS = 50
 
 def normalize_text(text):
     """
@@ -10,14 +26,140 @@ def normalize_text(text):
     """
     return ' '.join(text.split()).lower()
 
-def get_token_count(text: str | None) -> int:
+def get_content_hash(text: str) -> str:
     """
-    Get the number of tokens in the text assuming a token is roughly 3.5 characters (for margin)
+    Content address of a chunk, sha256 hex of the utf-8 text.
     """
-    if not text: return 0
+    return hashlib.sha256(text.encode()).hexdigest()
 
+@cache
+def get_encoding() -> tiktoken.Encoding:
+    """
+    Load the tokenizer once per process.
+    """
     # https://github.com/openai/tiktoken
-    return len(tiktoken.get_encoding("o200k_base").encode(text)) * 1.1 # slight margin of error
+    return tiktoken.get_encoding(ENCODING_NAME)
+
+class TokenCounter:
+    """
+    Memoized token counting.
+
+    - counts are cached by content hash in a bounded LRU, so re-sending the same instructions (e.g. the full document on every chunk call) is free.
+    - large batches of misses are encoded in a worker thread with encode_ordinary_batch, keeping the event loop responsive.
+    - concurrent requests for the same text share one encode.
+    """
+
+    def __init__(self, maxsize: int = TOKEN_COUNT_CACHE_SIZE, offload_min_chars: int = OFFLOAD_MIN_CHARS):
+        self.maxsize = maxsize
+        self.offload_min_chars = offload_min_chars
+
+        self._cache: OrderedDict[bytes, int] = OrderedDict()
+        self._pending: dict[bytes, asyncio.Future] = {}
+
+    @staticmethod
+    def _key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+    def _get(self, key: bytes) -> int | None:
+        count = self._cache.get(key)
+        if count is not None:
+            self._cache.move_to_end(key)
+        return count
+
+    def _put(self, key: bytes, count: int) -> None:
+        self._cache[key] = count
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def count(self, text: str | None) -> int:
+        """
+        Exact token count, encoded on the calling thread on a miss.
+        """
+        if not text: return 0
+
+        key = self._key(text)
+        count = self._get(key)
+        if count is None:
+            count = len(get_encoding().encode_ordinary(text))
+            self._put(key, count)
+
+        return count
+
+    async def count_batch(self, texts: list[str | None]) -> list[int]:
+        """
+        Exact token counts for a batch of texts.
+        """
+        counts = [0] * len(texts)
+        waiting: dict[int, asyncio.Future] = {}
+        misses: dict[bytes, list[int]] = {}
+        miss_texts: dict[bytes, str] = {}
+
+        for i, text in enumerate(texts):
+            if not text:
+                continue
+
+            key = self._key(text)
+            count = self._get(key)
+            if count is not None:
+                counts[i] = count
+            elif key in self._pending:
+                waiting[i] = self._pending[key]
+            else:
+                misses.setdefault(key, []).append(i)
+                miss_texts[key] = text
+
+        if misses:
+            loop = asyncio.get_running_loop()
+            futures = {key: loop.create_future() for key in misses}
+            self._pending.update(futures)
+
+            try:
+                batch = list(miss_texts.values())
+                if sum(len(it) for it in batch) >= self.offload_min_chars:
+                    encoded = await asyncio.to_thread(get_encoding().encode_ordinary_batch, batch)
+                else:
+                    encoded = get_encoding().encode_ordinary_batch(batch)
+
+                for key, tokens in zip(miss_texts, encoded):
+                    self._put(key, len(tokens))
+                    futures[key].set_result(len(tokens))
+                    for i in misses[key]:
+                        counts[i] = len(tokens)
+
+            except BaseException as ex:
+                # hand the failure to anyone sharing these encodes
+                for future in futures.values():
+                    if future.done():
+                        continue
+                    if isinstance(ex, asyncio.CancelledError):
+                        future.cancel()
+                    else:
+                        future.set_exception(ex)
+                raise
+
+            finally:
+                for key in futures:
+                    self._pending.pop(key, None)
+
+        for i, future in waiting.items():
+            counts[i] = await asyncio.shield(future)
+
+        return counts
+
+token_counter = TokenCounter()
+
+def get_token_count(text: str | None) -> int:
+    """
+    Get the number of tokens in the text with a slight margin, used for rate limiting.
+    """
+    return math.ceil(token_counter.count(text) * TOKEN_MARGIN)
+
+async def get_token_counts(texts: list[str | None]) -> list[int]:
+    """
+    Batched get_token_count. Large inputs are encoded off the event loop.
+    """
+    return [math.ceil(it * TOKEN_MARGIN) for it in await token_counter.count_batch(texts)]
 
 def generate_naive_chunks(text: str, chunk_size: int = 2**9, overlap: int = 2**7) -> Generator[str, None, None]:
     """
@@ -29,4 +171,171 @@ def generate_naive_chunks(text: str, chunk_size: int = 2**9, overlap: int = 2**7
         text_chunk = text[i : i + chunk_size]
         yield text_chunk
         i += chunk_size - overlap
-        
\ No newline at end of file
+
+def generate_token_chunks(text: str, chunk_tokens: int = CHUNK_TOKENS, overlap: int = CHUNK_OVERLAP_TOKENS) -> Generator[str, None, None]:
+    """
+    Chunk the text into windows of `chunk_tokens` tokens overlapping by `overlap` tokens.
+
+    The text is encoded once. Token offsets map each window back onto the original string, so chunks are plain slices 
+    of the input (no partial characters at the boundaries).
+    """
+    if overlap >= chunk_tokens:
+        raise ValueError(f"overlap ({overlap}) must be smaller than chunk_tokens ({chunk_tokens})")
+
+    encoding = get_encoding()
+    tokens = encoding.encode_ordinary(text)
+    _, offsets = encoding.decode_with_offsets(tokens)
+
+    i = 0
+    while i < len(tokens):
+        end = i + chunk_tokens
+        yield text[offsets[i] : offsets[end] if end < len(offsets) else len(text)]
+
+        if end >= len(tokens):
+            break
+        i = end - overlap
+
+
+TIMESTAMP_LINE = re.compile(r"^[ \t]*\d{1,2}:\d{2}(:\d{2})?[ \t]*$", re.MULTILINE)
+SECTION_HEADING = re.compile(
+    r"^(?:#{1,6}\s+\S.*|(?:S|O|A|P|Subjective|Objective|Assessment|Plan|Assessment and Plan|HPI|ROS|PMH|Medications|Allergies)\s*:.*)$", 
+    re.MULTILINE | re.IGNORECASE,
+)
+
+Chunker = Callable[[str], Iterator[str]]
+
+CHUNKERS: dict[str, Chunker] = {}
+
+def register_chunker(name: str) -> Callable[[Chunker], Chunker]:
+    """
+    Register a chunking strategy under `name` so chunk_document can pick it per document.
+    """
+    def decorator(func: Chunker) -> Chunker:
+        CHUNKERS[name] = func
+        return func
+    return decorator
+
+def get_chunker(name: str) -> Chunker:
+    chunker = CHUNKERS.get(name)
+    if chunker is None:
+        raise ValueError(f"No chunking strategy named {name}")
+    return chunker
+
+def normalize_newlines(text: str) -> str:
+    """
+    CRLF to LF, the line anchored patterns and the paragraph splits expect LF line endings.
+    """
+    return text.replace("\r\n", "\n")
+
+def detect_chunking_strategy(text: str) -> str:
+    """
+    Pick the chunking strategy for a document from its shape.
+    - transcripts with timestamped speaker turns -> speaker
+    - notes with SOAP / markdown headings -> section
+    - anything else -> token windows
+    """
+    text = normalize_newlines(text)
+    if len(TIMESTAMP_LINE.findall(text)) >= 3:
+        return "speaker"
+
+    if len(SECTION_HEADING.findall(text)) >= 2:
+        return "section"
+
+    return "token"
+
+def _split_at(text: str, starts: list[int]) -> list[str]:
+    """
+    Split text at the given character offsets, dropping empty pieces.
+    """
+    bounds = [0] + [it for it in starts if it > 0] + [len(text)]
+    return [text[a:b] for a, b in zip(bounds, bounds[1:]) if text[a:b].strip()]
+
+def _pack_segments(segments: Iterable[str], chunk_tokens: int) -> Generator[str, None, None]:
+    """
+    Greedily pack consecutive segments (sections, speaker turns) into chunks of at most `chunk_tokens` tokens.
+    A segment that is too large on its own falls back to token windows.
+    """
+    encoding = get_encoding()
+    buffer: list[str] = []
+    buffer_tokens = 0
+
+    for segment in segments:
+        n_tokens = len(encoding.encode_ordinary(segment))
+
+        if buffer and buffer_tokens + n_tokens > chunk_tokens:
+            yield "".join(buffer)
+            buffer, buffer_tokens = [], 0
+
+        if n_tokens > chunk_tokens:
+            yield from generate_token_chunks(segment, chunk_tokens)
+            continue
+
+        buffer.append(segment)
+        buffer_tokens += n_tokens
+
+    if buffer:
+        yield "".join(buffer)
+
+@register_chunker("naive")
+def generate_naive_document_chunks(text: str) -> Iterator[str]:
+    return generate_naive_chunks(text, chunk_size=2**10)
+
+@register_chunker("token")
+def generate_token_document_chunks(text: str) -> Iterator[str]:
+    return generate_token_chunks(text)
+
+@register_chunker("section")
+def generate_section_chunks(text: str, chunk_tokens: int = CHUNK_TOKENS) -> Generator[str, None, None]:
+    """
+    Split on section headings (SOAP S/O/A/P, common note headings, markdown) and pack whole sections into chunks.
+    """
+    text = normalize_newlines(text)
+    sections = _split_at(text, [m.start() for m in SECTION_HEADING.finditer(text)])
+    yield from _pack_segments(sections, chunk_tokens)
+
+@register_chunker("speaker")
+def generate_speaker_turn_chunks(text: str, chunk_tokens: int = CHUNK_TOKENS) -> Generator[str, None, None]:
+    """
+    Split a transcript into speaker turns and pack whole turns into chunks.
+    A turn starts at the paragraph holding a timestamp line (speaker name, title, timestamp, then the text).
+    """
+    text = normalize_newlines(text)
+    starts = []
+    for m in re.finditer(r"(?:^|\n\s*\n)(?=\S)", text):
+        end = text.find("\n\n", m.end())
+        paragraph = text[m.end() : end if end != -1 else len(text)]
+        if TIMESTAMP_LINE.search(paragraph):
+            starts.append(m.end())
+
+    turns = _split_at(text, starts)
+    yield from _pack_segments(turns, chunk_tokens)
+
+def split_document(text: str) -> tuple[str, list[str], int]:
+    """
+    The CPU bound part of chunking a document: pick the strategy, chunk, count the tokens.
+    Returns (chunking strategy, chunks, token count). Plain arguments and results so it can run in a worker process.
+    """
+    chunking_strategy = detect_chunking_strategy(text)
+    chunks = list(get_chunker(chunking_strategy)(text))
+    return chunking_strategy, chunks, token_counter.count(text)
+
+@cache
+def get_process_pool() -> ProcessPoolExecutor | None:
+    """
+    Process pool for the CPU bound stages, None unless CHUNKING_PROCESS_POOL_SIZE is set.
+    Workers come from a forkserver: forking the caller would copy its event loop, threads and their locks mid use.
+    """
+    if settings.CHUNKING_PROCESS_POOL_SIZE <= 0:
+        return None
+    return ProcessPoolExecutor(settings.CHUNKING_PROCESS_POOL_SIZE, mp_context = multiprocessing.get_context("forkserver"))
+
+async def run_cpu_bound(func: Callable[..., Any], *args: Any) -> Any:
+    """
+    Run `func` in the process pool when there is one, so it does not hold the GIL of the event loop. 
+    Otherwise inline. `func` and its arguments must be picklable.
+    """
+    pool = get_process_pool()
+    if pool is None:
+        return func(*args)
+
+    return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
@@ -1,4 +1,4 @@
-from src.services.schema import AIQuestionVariantsResponse, CodeLookupAction, DocumentChunkSimilarityRead, MedicalConcept
+from src.services.schema import AIQuestionVariantsResponse, CodeLookupAction, DocumentChunkSimilarityProjectionRead, MedicalConcept
 
 
 def _stitch_lines(*lines) -> str:
@@ -71,6 +71,41 @@ def get_chunk_prompt_input(chunk: str) -> str:
 
     return prompt.format(content=chunk)
 
+def get_chunk_batch_prompt_instructions(document: str) -> str:
+    """
+    Batched version of get_chunk_prompt_instructions, several chunks are hydrated per call. The document stays at the end so it remains a cacheable prefix.
+    """
+
+    prompt = _stitch_lines(
+        "You are a world-class *document context enhancer* used inside a Retrieval-Augmented Generation (RAG) pipeline.",
+        "Task:",
+        "- Given one full document and several extracted chunks, create concise supplemental context for every chunk.",
+        "",
+        "Rules:",
+        "- You will receive:",
+        "  - A full document enclosed in <Document> tags.",
+        "  - Several chunks from that document, each enclosed in <Chunk index=\"N\">...</Chunk> tags.",
+        "- For every chunk write a SHORT context string that:",
+        "  * Adds named entities, dates, section headings, or key facts missing from the chunk.",
+        "  * **Never** repeats text already present in the chunk.",
+        "- Return exactly one entry per chunk with the chunk's index. If a given chunk is self-contained its context is an empty string.",
+        "",
+        "<Document>{content}</Document>",
+    )
+
+    return prompt.format(content=document)
+
+def get_chunk_batch_prompt_input(chunks: list[tuple[int, str]]) -> str:
+    """
+    Get the prompt for a batch of (index, chunk) pairs.
+    """
+    prompt = _stitch_lines(
+        "",
+        "{chunks}",
+    )
+
+    return prompt.format(chunks = "\n".join(f"<Chunk index=\"{i}\">{chunk}</Chunk>" for i, chunk in chunks))
+
 def get_question_variants_instructions() -> str:
     prompt = _stitch_lines(
         "You are a world-class *question variant generator* used inside a Retrieval-Augmented Generation (RAG) pipeline.",
@@ -121,7 +156,33 @@ def get_rag_qa_instructions() -> str:
 
     return prompt
 
-def get_rag_qa_input(question: str, chunks: list[DocumentChunkSimilarityRead]):
+def get_rag_qa_stream_instructions() -> str:
+    """
+    Plain text variant of get_rag_qa_instructions for streaming, citations are read back from the answer.
+    """
+    prompt = _stitch_lines(
+        "You are a world-class evidence-grounded answer generator in a Retrieval-Augmented Generation (RAG) pipeline.",
+        "",
+        "## Task",
+        "- Answer the user’s question **solely** using the provided evidence chunks.",
+        "- Write 1–3 well-formed sentences unless more detail is unavoidable.",
+        "",
+        "## Input format",
+        "- <Question>...</Question>: the user’s question.",
+        "- <Chunks>...</Chunks>: evidence chunks, each inside <Chunk id=\"X\" document_id=\"Y\">...</Chunk>.",
+        "",
+        "## Rules",
+        "- Use information **only from the chunks**; do *not* add outside knowledge.",
+        "- If the chunks lack enough information, reply exactly: “I don’t have sufficient information to answer.”",
+        "- Cite every chunk you use by its id in square brackets right after the statement it supports, e.g. [12].",
+        "- Reply with the answer text only: no JSON, no markdown, no list of sources at the end.",
+        "- Write in clear, professional prose.",
+        "",
+    )
+
+    return prompt
+
+def get_rag_qa_input(question: str, chunks: list[DocumentChunkSimilarityProjectionRead]):
     prompt = _stitch_lines(
         "<Question>{question}</Question>",
         "<Chunks>{chunks}</Chunks>",
@@ -1,42 +1,383 @@
-from asyncio import Semaphore
 import asyncio
 from collections import deque
-from dataclasses import dataclass
-import random
-import time
+from dataclasses import dataclass, field
+from enum import Enum
+import math
+
+from src.ai.models import Models
+from src.db.engine import AsyncUnitOfWork
 from src.env import settings
 
-MAX_TOKENS_MIN = 200000
-MAX_REQ_MIN = 20
+WINDOW_SECONDS = 60
+
+class Priority(int, Enum):
+    """
+    Traffic classes, lower value is served first.
+    """
+    INTERACTIVE = 0     # user facing endpoints
+    BATCH = 1           # bulk work a user is still waiting on
+    BACKGROUND = 2      # ingestion, soaks up whatever is left
+
+# the share of the window each class may fill. the remainder is held back for the classes above it,
+# so a large upload can never push interactive traffic into a full minute wait.
+PRIORITY_SHARES: dict[Priority, float] = {
+    Priority.INTERACTIVE: 1.0,
+    Priority.BATCH: .8,
+    Priority.BACKGROUND: .6,
+}
+
+# AIMD on the usable fraction of the window: halve on a 429, creep back up with every healthy response.
+BACKOFF_FACTOR = .5
+RECOVERY_STEP = .05
+MIN_SCALE = .1
+
+# postgres backend: floor on how long a waiter sleeps before retrying, and the extra delay per priority level
+# so the interactive waiters of a process get first pick when capacity frees up.
+MIN_RETRY_SECONDS = .05
+PRIORITY_RETRY_DELAY = .05
 
-@dataclass(frozen=True)
+@dataclass
 class LogItem:
+    """
+    A reservation in the window. num_tokens starts as the estimate and is corrected by `settle` once the real usage is known.
+    """
     timestamp: float
     num_tokens: int
+    num_requests: int = 1
+    ledger_id: int | None = None    # row in rate_limit_ledger when using the postgres backend
+
+@dataclass
+class Waiter:
+    num_tokens: int
+    future: asyncio.Future = field(repr=False)
+
+class SlidingWindowRateLimiter:
+    """
+    Sliding window limiter on both tokens and requests per minute.
+
+    - running totals are kept alongside the log so checking capacity is O(1) (amortized over expiry).
+    - waiters are served strictly in FIFO order. Each waiter parks on a future that is resolved
+      by a timer scheduled for the exact moment the oldest log entry leaves the window.
+    - every priority class has its own FIFO lane. Lanes are served in priority order, a lower lane only
+      moves while every lane above it is empty, and only up to its share of the window (PRIORITY_SHARES).
+    - acquire reserves an estimate and returns the log item; `settle` swaps the estimate for the actual usage
+      and frees (or charges) the difference right away.
+    - the server's view is fed back through `observe_capacity` (x-ratelimit-* headers) and `observe_rate_limited` (429s).
+      The org limits replace the configured ones, usage we can not see (other processes/services on the same key)
+      is held as an external reservation, and 429s pause the bucket and shrink it until it recovers.
+
+    Everything runs on the event loop without awaiting in between, so no lock is needed.
+    """
+
+    def __init__(self, max_tokens: int, max_requests: int, window: float = WINDOW_SECONDS):
+        self.max_tokens = max_tokens
+        self.max_requests = max_requests
+        self.window = window
+
+        self.log: deque[LogItem] = deque()
+        self.tokens_in_window = 0
+        self.requests_in_window = 0
+        self.scale = 1.0
+        self.paused_until = 0.0
+        self.waiters: dict[Priority, deque[Waiter]] = {priority: deque() for priority in Priority}
+        self._timer: asyncio.TimerHandle | None = None
+
+    def _expire(self, now: float) -> None:
+        while self.log and (now - self.log[0].timestamp) >= self.window:
+            item = self.log.popleft()
+            self.tokens_in_window -= item.num_tokens
+            self.requests_in_window -= item.num_requests
+
+    def _fits(self, now: float, num_tokens: int, priority: Priority) -> bool:
+        if now < self.paused_until:
+            return False
+
+        if not self.log:
+            # a request larger than the whole budget can only go through on an empty window
+            return True
+
+        share = PRIORITY_SHARES[priority] * self.scale
+        max_tokens = self.max_tokens * share
+        max_requests = max(1, math.floor(self.max_requests * share))
+
+        return self.tokens_in_window + num_tokens <= max_tokens and self.requests_in_window < max_requests
+
+    def _has_waiters(self, above: Priority | None = None) -> bool:
+        """
+        Are there any waiters, or any waiters in a lane with a higher priority than `above`.
+        """
+        return any(
+            lane for priority, lane in self.waiters.items()
+            if above is None or priority < above
+        )
+
+    def _record(self, now: float, num_tokens: int, num_requests: int = 1) -> LogItem:
+        item = LogItem(now, num_tokens, num_requests)
+        self.log.append(item)
+        self.tokens_in_window += num_tokens
+        self.requests_in_window += num_requests
+        return item
+
+    def _serve(self) -> None:
+        """
+        Grant capacity to the waiters at the head of the queue, then schedule the next wake up if anyone is still waiting.
+        """
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self._expire(now)
+
+        for priority, lane in self.waiters.items():
+            while lane:
+                waiter = lane[0]
+                if waiter.future.done():
+                    # cancelled while waiting
+                    lane.popleft()
+                    continue
+
+                if not self._fits(now, waiter.num_tokens, priority):
+                    break
+
+                lane.popleft()
+                waiter.future.set_result(self._record(now, waiter.num_tokens))
+
+            if lane:
+                # head of this lane is blocked, lower lanes wait behind it
+                break
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if not self._has_waiters():
+            return
+
+        # capacity frees up when the oldest entry expires or when a 429 pause ends, whichever comes first
+        wake_ups = []
+        if self.log:
+            wake_ups.append(self.log[0].timestamp + self.window)
+        if self.paused_until > now:
+            wake_ups.append(self.paused_until)
+
+        if wake_ups:
+            self._timer = loop.call_at(min(wake_ups), self._on_timer)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._serve()
+
+    async def acquire(self, num_tokens: int, priority: Priority = Priority.INTERACTIVE) -> LogItem:
+        """
+        Wait until `num_tokens` and one request fit in the window for the given priority, then record them.
+        Returns the reservation so it can be settled later.
+        """
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self._expire(now)
+
+        if not self._has_waiters(above = priority) and not self.waiters[priority] and self._fits(now, num_tokens, priority):
+            return self._record(now, num_tokens)
+
+        waiter = Waiter(num_tokens, loop.create_future())
+        self.waiters[priority].append(waiter)
+        self._serve()
+
+        try:
+            return await waiter.future
+        except asyncio.CancelledError:
+            # let the next in line through if we were blocking the head
+            self._serve()
+            raise
+
+    async def settle(self, reservation: LogItem, num_tokens: int) -> None:
+        """
+        Replace the reserved estimate with the actual usage. Nothing to do if the reservation already left the window.
+        """
+        loop = asyncio.get_running_loop()
+        self._expire(loop.time())
+
+        if not self.log or reservation.timestamp < self.log[0].timestamp:
+            return
+
+        delta = int(num_tokens) - reservation.num_tokens
+        reservation.num_tokens += delta
+        self.tokens_in_window += delta
+
+        if delta < 0:
+            self._serve()
+
+    async def observe_capacity(self, limit_tokens: int | None, remaining_tokens: int | None, limit_requests: int | None, remaining_requests: int | None) -> None:
+        """
+        Sync with the rate limit headers of a successful response.
+        """
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self._expire(now)
+
+        # the org limits are the truth, both when they are higher than configured and when they are lower
+        if limit_tokens:
+            self.max_tokens = limit_tokens
+        if limit_requests:
+            self.max_requests = limit_requests
+
+        # the server sees less room than we do, someone else is spending the same quota.
+        # hold the difference for a window so we stop competing with them for it.
+        missing_tokens = 0 if remaining_tokens is None else max(0, self.max_tokens - self.tokens_in_window - remaining_tokens)
+        missing_requests = 0 if remaining_requests is None else max(0, self.max_requests - self.requests_in_window - remaining_requests)
+        if missing_tokens or missing_requests:
+            self._record(now, missing_tokens, missing_requests)
+
+        self.scale = min(1.0, self.scale + RECOVERY_STEP)
+        self._serve()
+
+    async def observe_rate_limited(self, retry_after: float) -> None:
+        """
+        The server rejected a request with a 429. Stop granting until it says we can retry, and shrink the usable window.
+        """
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+
+        self.paused_until = max(self.paused_until, now + retry_after)
+        self.scale = max(MIN_SCALE, self.scale * BACKOFF_FACTOR)
+        self._serve()
+
+class PostgresRateLimiter:
+    """
+    Cross process limiter with the same interface as SlidingWindowRateLimiter. 
+    The window lives in the rate_limit_ledger table so every uvicorn worker and container draws from one budget.
+
+    - reservations are checked and written under a per model advisory lock.
+    - waiters sleep until the oldest reservation leaves the window (or a 429 pause ends) and try again.
+      Priority shares, scale and pauses behave like the in process limiter.
+    """
+
+    def __init__(self, model: Models, max_tokens: int, max_requests: int, window: float = WINDOW_SECONDS):
+        self.model = model
+        self.max_tokens = max_tokens
+        self.max_requests = max_requests
+        self.window = window
+
+        self.scale = 1.0
+        self.paused_until = 0.0
+
+    def _fits(self, tokens_in_window: int, requests_in_window: int, num_tokens: int, priority: Priority) -> bool:
+        if not requests_in_window:
+            return True
+
+        share = PRIORITY_SHARES[priority] * self.scale
+        max_tokens = self.max_tokens * share
+        max_requests = max(1, math.floor(self.max_requests * share))
+
+        return tokens_in_window + num_tokens <= max_tokens and requests_in_window < max_requests
+
+    async def _try_acquire(self, num_tokens: int, priority: Priority) -> tuple[LogItem | None, float]:
+        """
+        One attempt at a reservation. Returns the reservation, or None and how long to wait before trying again.
+        """
+        async with AsyncUnitOfWork() as uow:
+            await uow.rate_limits.lock(self.model.value)
+            await uow.rate_limits.purge(self.model.value, self.window)
+            tokens_in_window, requests_in_window, expires_in = await uow.rate_limits.get_usage(self.model.value, self.window)
+
+            if not self._fits(tokens_in_window, requests_in_window, num_tokens, priority):
+                return None, expires_in or MIN_RETRY_SECONDS
+
+            db_item = await uow.rate_limits.create(self.model.value, num_tokens)
+            return LogItem(asyncio.get_running_loop().time(), num_tokens, ledger_id = db_item.id), 0
+
+    async def acquire(self, num_tokens: int, priority: Priority = Priority.INTERACTIVE) -> LogItem:
+        """
+        Wait until `num_tokens` and one request fit in the shared window for the given priority, then record them.
+        """
+        loop = asyncio.get_running_loop()
+
+        while True:
+            now = loop.time()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now + priority * PRIORITY_RETRY_DELAY)
+                continue
+
+            reservation, wait_time = await self._try_acquire(num_tokens, priority)
+            if reservation is not None:
+                return reservation
+
+            await asyncio.sleep(max(MIN_RETRY_SECONDS, wait_time) + priority * PRIORITY_RETRY_DELAY)
+
+    async def settle(self, reservation: LogItem, num_tokens: int) -> None:
+        """
+        Replace the reserved estimate with the actual usage.
+        """
+        if reservation.ledger_id is None:
+            return
+
+        async with AsyncUnitOfWork() as uow:
+            await uow.rate_limits.update_tokens(reservation.ledger_id, int(num_tokens))
+
+        reservation.num_tokens = int(num_tokens)
+
+    async def observe_capacity(self, limit_tokens: int | None, remaining_tokens: int | None, limit_requests: int | None, remaining_requests: int | None) -> None:
+        """
+        Sync with the rate limit headers of a successful response. See SlidingWindowRateLimiter.observe_capacity
+        """
+        if limit_tokens:
+            self.max_tokens = limit_tokens
+        if limit_requests:
+            self.max_requests = limit_requests
+
+        self.scale = min(1.0, self.scale + RECOVERY_STEP)
+
+        if remaining_tokens is None and remaining_requests is None:
+            return
+
+        async with AsyncUnitOfWork() as uow:
+            await uow.rate_limits.lock(self.model.value)
+            tokens_in_window, requests_in_window, _ = await uow.rate_limits.get_usage(self.model.value, self.window)
+
+            # with every process in the ledger, anything missing is spent outside of this deployment
+            missing_tokens = 0 if remaining_tokens is None else max(0, self.max_tokens - tokens_in_window - remaining_tokens)
+            missing_requests = 0 if remaining_requests is None else max(0, self.max_requests - requests_in_window - remaining_requests)
+            if missing_tokens or missing_requests:
+                await uow.rate_limits.create(self.model.value, missing_tokens, missing_requests)
+
+    async def observe_rate_limited(self, retry_after: float) -> None:
+        """
+        The server rejected a request with a 429. Stop granting until it says we can retry, and shrink the usable window.
+        """
+        now = asyncio.get_running_loop().time()
+
+        self.paused_until = max(self.paused_until, now + retry_after)
+        self.scale = max(MIN_SCALE, self.scale * BACKOFF_FACTOR)
+
+def _create_limiter(model: Models) -> SlidingWindowRateLimiter | PostgresRateLimiter:
+    if settings.RATE_LIMITER_BACKEND == "postgres":
+        return PostgresRateLimiter(model, settings.OPENAI_MAX_TOKENS_MIN, settings.OPENAI_MAX_REQ_MIN)
 
-request_log: deque[LogItem] = deque()
-lock = asyncio.Lock()
+    return SlidingWindowRateLimiter(settings.OPENAI_MAX_TOKENS_MIN, settings.OPENAI_MAX_REQ_MIN)
 
-async def request_access(num_tokens: int) -> None:
-    while True:
-        now = time.perf_counter()
+limiters: dict[Models, SlidingWindowRateLimiter | PostgresRateLimiter] = {
+    model: _create_limiter(model)
+    for model in Models
+}
 
-        async with lock:
-            while request_log and (now - request_log[0].timestamp) > 60:
-                request_log.popleft()
-            
-            tokens_last_minute = sum(li.num_tokens for li in request_log)
-            requests_last_minute = len(request_log)
+async def request_access(num_tokens: int, model: Models = Models.FULL, priority: Priority = Priority.INTERACTIVE) -> LogItem:
+    """
+    Wait for capacity on the model's bucket. Returns the reservation to settle once the usage is known.
+    """
+    return await limiters[model].acquire(int(num_tokens), priority)
 
-            if tokens_last_minute + num_tokens < MAX_TOKENS_MIN and requests_last_minute < MAX_REQ_MIN:
-                request_log.append(LogItem(now, num_tokens))
-                return
-            
-            else:
-                wait_time = 60 - (now - request_log[0].timestamp) + 5 # for some buffer
-        
-        await asyncio.sleep(wait_time) 
-           
+async def settle_access(reservation: LogItem, num_tokens: int, model: Models = Models.FULL) -> None:
+    """
+    Correct a reservation on the model's bucket with the actual token usage.
+    """
+    await limiters[model].settle(reservation, num_tokens)
 
+async def report_capacity(model: Models, limit_tokens: int | None, remaining_tokens: int | None, limit_requests: int | None, remaining_requests: int | None) -> None:
+    """
+    Feed the server's rate limit headers back into the model's bucket.
+    """
+    await limiters[model].observe_capacity(limit_tokens, remaining_tokens, limit_requests, remaining_requests)
 
-    
\ No newline at end of file
+async def report_rate_limited(model: Models, retry_after: float) -> None:
+    """
+    Feed a 429 back into the model's bucket.
+    """
+    await limiters[model].observe_rate_limited(retry_after)
@@ -0,0 +1,66 @@
+"""
+Token usage telemetry for the responses api, mainly to see how much of our input hits the provider's prompt cache.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Iterator
+
+from src.ai.models import Models
+from src._logging import get_logger
+
+logger = get_logger(__name__)
+
+@dataclass
+class UsageStats:
+    calls: int = 0
+    input_tokens: int = 0
+    cached_tokens: int = 0
+    output_tokens: int = 0
+
+    @property
+    def cache_hit_ratio(self) -> float:
+        """
+        Share of the input tokens served from the prompt cache.
+        """
+        return self.cached_tokens / self.input_tokens if self.input_tokens else 0.
+
+    def add(self, input_tokens: int, cached_tokens: int, output_tokens: int) -> None:
+        self.calls += 1
+        self.input_tokens += input_tokens
+        self.cached_tokens += cached_tokens
+        self.output_tokens += output_tokens
+
+# process wide totals per model
+usage_totals: defaultdict[Models, UsageStats] = defaultdict(UsageStats)
+
+# the stats of every `track_usage` block the current task runs in. tasks spawned inside a block inherit it.
+_scopes: ContextVar[tuple[UsageStats, ...]] = ContextVar("usage_scopes", default=())
+
+@contextmanager
+def track_usage() -> Iterator[UsageStats]:
+    """
+    Collect the usage of every call made inside the block, including calls made by tasks it spawns.
+    """
+    stats = UsageStats()
+    token = _scopes.set(_scopes.get() + (stats,))
+    try:
+        yield stats
+    finally:
+        _scopes.reset(token)
+
+def record_usage(model: Models, usage) -> None:
+    """
+    Record the usage of a responses api call.
+    """
+    if usage is None:
+        return
+
+    details = getattr(usage, "input_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) or 0
+
+    logger.debug(f"{model.value}: input {usage.input_tokens} (cached {cached_tokens}), output {usage.output_tokens}")
+
+    for stats in (usage_totals[model], *_scopes.get()):
+        stats.add(usage.input_tokens, cached_tokens, usage.output_tokens)
@@ -1,25 +1,39 @@
 import asyncio
 from contextlib import asynccontextmanager
+import json
+from typing import AsyncIterator
 from fastapi import BackgroundTasks, FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 
 from src.ai.client import OpenAIError
+from src.ai.usage import usage_totals
 from src.db.engine import init_db
-from src.services.schema import DocumentCreate
+from src.db.repositories import DocumentNotFoundError, DuplicateDocumentError
+from src.env import settings
+from src.services.schema import DocumentCreate, DocumentUpdate
 from src.services import documents as documents_service
 from src.services import ai as ai_service
-from src.api.schema import DocumentGetResponse, DocumentPostResponse, ExtractStructuredRequest, ExtractStructuredResponse, HealthCheckResponse, DocumentPostRequest, QuestionPostRequest, QuestionPostResponse, SummarizePostResponse, SummarizePostRequest, ToFHIRRequest, ToFHIRResponse
+from src.api.schema import DocumentGetResponse, DocumentPatchRequest, DocumentPatchResponse, DocumentPostResponse, DocumentResumePostResponse, ExtractStructuredRequest, ExtractStructuredResponse, HealthCheckResponse, DocumentPostRequest, QuestionPostRequest, QuestionPostResponse, SummarizePostResponse, SummarizePostRequest, ToFHIRRequest, ToFHIRResponse, UsageGetResponse, UsageStatsResponse
 from src._logging import get_logger
 
 logger = get_logger(__name__)
 
+# no buffering by proxies (nginx) so events reach the client as they are produced
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
 init_db()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):    
-    chunking_worker = asyncio.create_task(ai_service.document_chunking_worker())
+    chunking_worker = None
+    if settings.RUN_CHUNKING_WORKER:
+        chunking_worker = asyncio.create_task(ai_service.document_chunking_worker())
 
     yield
 
+    if chunking_worker is not None:
+        chunking_worker.cancel()
+
 app = FastAPI(lifespan=lifespan)
 
 @app.get("/health", response_model=HealthCheckResponse)
@@ -30,22 +44,66 @@ async def health_check() -> HealthCheckResponse:
 
     return HealthCheckResponse(status="OK")
 
+@app.get("/usage", response_model=UsageGetResponse)
+async def get_usage():
+    """
+    Token usage and prompt cache hit ratio of this process since startup.
+    Chunking only shows up here with RUN_CHUNKING_WORKER=true, a standalone worker logs the usage of each document it hydrates instead.
+    """
+    return UsageGetResponse(models = {
+        model.value: UsageStatsResponse(
+            calls = stats.calls,
+            input_tokens = stats.input_tokens,
+            cached_tokens = stats.cached_tokens,
+            output_tokens = stats.output_tokens,
+            cache_hit_ratio = stats.cache_hit_ratio,
+        )
+        for model, stats in usage_totals.items()
+    })
+
 @app.get("/documents", response_model=DocumentGetResponse)
 async def get_documents():
     """
     Get all documents from the database.
     """
-    return DocumentGetResponse(documents = documents_service.get_documents())
+    return DocumentGetResponse(documents = await documents_service.get_documents())
 
 @app.post("/documents", response_model=DocumentPostResponse, status_code = 202)
 async def post_documents(req: DocumentPostRequest, background: BackgroundTasks ):
     """
     Insert a document into the database.
     """
-    documents_service.create_document(DocumentCreate(title =req.title, content = req.content))
+    try:
+        await documents_service.create_document(DocumentCreate(title =req.title, content = req.content))
+    except DuplicateDocumentError as ex:
+        raise HTTPException(status_code=409, detail=str(ex))
 
     return DocumentPostResponse()
 
+@app.patch("/documents/{document_id}", response_model=DocumentPatchResponse, status_code = 202)
+async def patch_document(document_id: int, req: DocumentPatchRequest):
+    """
+    Edit a document. Only the chunks that changed are hydrated and embedded again.
+    """
+    try:
+        await documents_service.edit_document(DocumentUpdate(id = document_id, **req.model_dump(exclude_none=True)))
+    except DocumentNotFoundError as ex:
+        raise HTTPException(status_code=404, detail=str(ex))
+
+    return DocumentPatchResponse()
+
+@app.post("/documents/{document_id}/resume", response_model=DocumentResumePostResponse, status_code = 202)
+async def post_document_resume(document_id: int):
+    """
+    Queue a document for chunking again, e.g. one that ran out of attempts. Chunks already hydrated and embedded are kept.
+    """
+    try:
+        await documents_service.requeue_document(document_id)
+    except DocumentNotFoundError as ex:
+        raise HTTPException(status_code=404, detail=str(ex))
+
+    return DocumentResumePostResponse()
+
 @app.post("/answer_question", response_model=QuestionPostResponse)
 async def post_answer_question(req: QuestionPostRequest):
     """
@@ -56,6 +114,45 @@ async def post_answer_question(req: QuestionPostRequest):
     answer = await ai_service.get_question_answer(req.question)
     return QuestionPostResponse(**answer.model_dump())
 
+def _sse(event: str, data: dict) -> str:
+    """
+    Format one server-sent event.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def _sse_stream(events: AsyncIterator[str]) -> AsyncIterator[str]:
+    """
+    Errors raised once the stream started cannot become an http error anymore, they are sent as a final `error` event.
+    """
+    try:
+        async for event in events:
+            yield event
+
+    except OpenAIError as e:
+        logger.exception(e)
+        yield _sse("error", {"detail": "OpenAI API error"})
+
+    except Exception as e:
+        logger.exception(e)
+        yield _sse("error", {"detail": "Internal server error"})
+
+@app.post("/answer_question/stream", response_class=StreamingResponse)
+async def post_answer_question_stream(req: QuestionPostRequest):
+    """
+    Server-sent event version of /answer_question.
+    Streams `delta` events ({"text"}) as the answer is generated, then one `citations` event ({"answer", "citations"}).
+    """
+    logger.debug(f"{req}")
+
+    async def events():
+        async for item in ai_service.stream_question_answer(req.question):
+            if isinstance(item, str):
+                yield _sse("delta", {"text": item})
+            else:
+                yield _sse("citations", QuestionPostResponse(**item.model_dump()).model_dump())
+
+    return StreamingResponse(_sse_stream(events()), media_type="text/event-stream", headers=SSE_HEADERS)
+
 @app.post("/summarize_note", response_model=SummarizePostResponse)
 async def post_summarize_note(req: SummarizePostRequest):
     """
@@ -76,6 +173,24 @@ async def post_summarize_note(req: SummarizePostRequest):
         logger.exception(e)
         raise HTTPException(status_code=500, detail="Internal server error")
     
+@app.post("/summarize_note/stream", response_class=StreamingResponse)
+async def post_summarize_note_stream(req: SummarizePostRequest):
+    """
+    Server-sent event version of /summarize_note.
+    Streams `delta` events ({"text"}) as the summary is generated, then one `done` event ({"summary"}).
+    """
+    logger.debug(f"{req}")
+
+    async def events():
+        parts = []
+        async for delta in ai_service.stream_summary(req.content):
+            parts.append(delta)
+            yield _sse("delta", {"text": delta})
+
+        yield _sse("done", SummarizePostResponse(summary = "".join(parts)).model_dump())
+
+    return StreamingResponse(_sse_stream(events()), media_type="text/event-stream", headers=SSE_HEADERS)
+
 @app.post("/extract_structured", response_model=ExtractStructuredResponse)
 async def post_extract_structured(req: ExtractStructuredRequest):
     """
@@ -1,4 +1,4 @@
-from typing import Literal
+from typing import Literal, Optional
 from pydantic import BaseModel, Field
 from fhir.resources.bundle import Bundle
 from src.services.schema import AIRagResponse, DocumentRead, DumbStructuredNote
@@ -16,6 +16,16 @@ class DocumentPostRequest(BaseModel):
 class DocumentPostResponse(BaseModel):
     message:str = "Document accepted. Beginning chunking."
 
+class DocumentPatchRequest(BaseModel):
+    title: Optional[str] = Field(None, description="New title of the document", min_length=4)
+    content: Optional[str] = Field(None, description="New content of the document", min_length=4)
+
+class DocumentPatchResponse(BaseModel):
+    message:str = "Document updated. Re-indexing the changed chunks."
+
+class DocumentResumePostResponse(BaseModel):
+    message:str = "Document queued. Chunking resumes where it stopped."
+
 class QuestionPostRequest(BaseModel):
     question: str = Field(..., description="Question to be asked.")
 
@@ -38,4 +48,14 @@ class ToFHIRRequest(BaseModel):
     structured_note: DumbStructuredNote = Field(..., description = "The structured note json as output from /extract_structured")
 
 class ToFHIRResponse(Bundle):
-    pass
\ No newline at end of file
+    pass
+
+class UsageStatsResponse(BaseModel):
+    calls: int = Field(..., description="Number of responses api calls.")
+    input_tokens: int = Field(..., description="Input tokens billed.")
+    cached_tokens: int = Field(..., description="Input tokens served from the prompt cache.")
+    output_tokens: int = Field(..., description="Output tokens billed.")
+    cache_hit_ratio: float = Field(..., description="cached_tokens / input_tokens")
+
+class UsageGetResponse(BaseModel):
+    models: dict[str, UsageStatsResponse] = Field(default_factory=dict, description="Usage of this process since startup, per model.")
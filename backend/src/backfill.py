@@ -0,0 +1,22 @@
+"""
+Backfill content hashes and link duplicate documents, for rows inserted before chunk re-indexing and ingest deduplication.
+
+    python -m src.backfill
+
+Safe to run more than once: only chunks and documents without a hash are hashed, and only canonical documents sharing their content are linked.
+"""
+import asyncio
+
+from src.db.engine import init_db
+from src.services import documents as documents_service
+from src._logging import get_logger
+
+logger = get_logger(__name__)
+
+async def main() -> None:
+    counts = await documents_service.backfill_documents()
+    logger.info(f"Hashed {counts['chunks_hashed']} chunks and {counts['hashed']} documents, linked {counts['linked']} duplicates in {counts['groups']} groups")
+
+if __name__ == "__main__":
+    init_db()
+    asyncio.run(main())
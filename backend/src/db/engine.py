@@ -1,9 +1,13 @@
 from functools import cache
-from sqlalchemy import create_engine, text
+import psycopg
+from pgvector.psycopg import register_vector_async
+from sqlalchemy import create_engine, event, make_url, text
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
 from src.db.models import ModelBase
-from src.db.repositories import DocumentChunkRepository, DocumentRepository
+from src.db.repositories import AsyncDocumentChunkRepository, AsyncDocumentRepository, AsyncEmbeddingCacheRepository, AsyncRateLimitRepository, AsyncResponseCacheRepository, DocumentChunkRepository, DocumentRepository
+from src.env import settings
 
 @cache
 def get_engine():
@@ -12,19 +16,82 @@ def get_engine():
     Cached so we dont spam the db with connections.
     """
     return create_engine(
-        "postgresql+psycopg://postgres:postgres@db:5432/ascertain",
+        settings.DATABASE_URL,
+        pool_size = settings.DB_POOL_SIZE,
+        max_overflow = settings.DB_MAX_OVERFLOW,
         pool_pre_ping=True,
         echo = False,
         
     )
 
+@cache
+def get_async_engine() -> AsyncEngine:
+    """
+    Create the async connection pool (psycopg async). Used by the request handlers and the chunking worker so db calls dont block the event loop.
+    Cached so we dont spam the db with connections.
+    """
+    engine = create_async_engine(
+        settings.DATABASE_URL,
+        pool_size = settings.DB_POOL_SIZE,
+        max_overflow = settings.DB_MAX_OVERFLOW,
+        pool_pre_ping=True,
+        echo = False,
+    )
+
+    # once per pooled connection: the binary vector dumper/loader used by the COPY in save_results
+    @event.listens_for(engine.sync_engine, "connect")
+    def register_vector(dbapi_connection, connection_record):
+        dbapi_connection.run_async(register_vector_async)
+
+    return engine
+
+# create_all only creates missing tables, columns added to existing tables are listed here. must be idempotent.
+_MIGRATIONS = [
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS ingestion_strategy VARCHAR(9)",
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP WITH TIME ZONE",
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS chunking_attempts INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS chunks_total INTEGER",
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS chunks_done INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE document_chunks ADD COLUMN IF NOT EXISTS position INTEGER",
+    "ALTER TABLE document_chunks ALTER COLUMN context DROP NOT NULL",
+    "ALTER TABLE document_chunks ALTER COLUMN embedding DROP NOT NULL",
+    "CREATE INDEX IF NOT EXISTS ix_document_chunks_document_id_position ON document_chunks (document_id, position)",
+    "ALTER TABLE document_chunks ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)",
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)",
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS canonical_id INTEGER REFERENCES documents (id) ON DELETE SET NULL",
+    "CREATE INDEX IF NOT EXISTS ix_documents_content_hash ON documents (content_hash)",
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS chunking_claim INTEGER NOT NULL DEFAULT 0",
+    # keep embeddings inline instead of toasted: a seq scan over toasted vectors looks cheap to the planner, which then skips the hnsw index.
+    # only applies to rows written from now on.
+    "ALTER TABLE document_chunks ALTER COLUMN embedding SET STORAGE PLAIN",
+]
+
+async def get_listen_connection() -> psycopg.AsyncConnection:
+    """
+    A dedicated autocommit connection for LISTEN. Notifications need a connection held open outside of the pool.
+    """
+    url = make_url(settings.DATABASE_URL).set(drivername = "postgresql")
+    return await psycopg.AsyncConnection.connect(url.render_as_string(hide_password = False), autocommit = True)
+
+# any constant shared by every process running init_db
+_INIT_DB_LOCK = 7_120_240
+
 def init_db():
+    """
+    Create the extension, the tables and apply _MIGRATIONS, in one transaction.
+    The api, the worker and the scripts all call it on startup: the advisory lock makes concurrent starts run it one after the other
+    instead of racing on CREATE EXTENSION / CREATE TABLE. Data backfills do not belong here, see src.backfill.
+    """
     with get_engine().begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _INIT_DB_LOCK})
         conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
-        
-    ModelBase.metadata.create_all(bind = get_engine())
+        ModelBase.metadata.create_all(bind = conn)
+
+        for migration in _MIGRATIONS:
+            conn.execute(text(migration))
 
 session_factory = sessionmaker( bind=get_engine(), autoflush=True )
+async_session_factory = async_sessionmaker( bind=get_async_engine(), autoflush=True, expire_on_commit=False )
 
 class UnitOfWork():
     """
@@ -48,5 +115,30 @@ class UnitOfWork():
         self.session.close()
         return False
 
+class AsyncUnitOfWork():
+    """
+    Async Unit of Work. Same contract as UnitOfWork but backed by an AsyncSession.
+    """
+
+    def __init__(self):
+        self.session = async_session_factory()
+        self.documents: AsyncDocumentRepository = AsyncDocumentRepository(self.session)
+        self.chunks: AsyncDocumentChunkRepository = AsyncDocumentChunkRepository(self.session)
+        self.rate_limits: AsyncRateLimitRepository = AsyncRateLimitRepository(self.session)
+        self.response_cache: AsyncResponseCacheRepository = AsyncResponseCacheRepository(self.session)
+        self.embedding_cache: AsyncEmbeddingCacheRepository = AsyncEmbeddingCacheRepository(self.session)
+
+    async def __aenter__(self) -> "AsyncUnitOfWork":
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            await self.session.rollback()
+        else:
+            await self.session.commit()
+
+        await self.session.close()
+        return False
+
 if __name__ == "__main__":
-    init_db()
\ No newline at end of file
+    init_db()
@@ -1,8 +1,9 @@
-from sqlalchemy import Boolean, Column, DateTime, Enum, ForeignKey, Index, Integer, String
+from datetime import datetime
+from sqlalchemy import Boolean, Column, DateTime, Enum, ForeignKey, Index, Integer, String, func
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 from pgvector.sqlalchemy import Vector
 
-from src.services.schema import ChunkingStage
+from src.services.schema import ChunkingStage, IngestionStrategy
 from src.ai.models import EMBED_DIM
 
 class ModelBase(DeclarativeBase):
@@ -14,7 +15,17 @@ class Document(ModelBase):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     title: Mapped[str] = mapped_column(String, nullable=False)
     content: Mapped[str] = mapped_column(String, nullable=False)
+    content_hash: Mapped[str | None] = mapped_column(String(64), nullable=True, index=True)
+    # set on a duplicate of an already ingested document: it has no chunks of its own and shares the canonical one's
+    canonical_id: Mapped[int | None] = mapped_column(Integer, ForeignKey("documents.id", ondelete="SET NULL"), nullable=True)
     chunking_stage: Mapped[ChunkingStage] = mapped_column(Enum(ChunkingStage), nullable=False, default=ChunkingStage.NOT_STARTED)
+    ingestion_strategy: Mapped[IngestionStrategy | None] = mapped_column(Enum(IngestionStrategy, native_enum=False), nullable=True)
+    lease_expires_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    chunking_attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    # bumped by every claim and requeue. a run only writes while the claim it started with is still the current one
+    chunking_claim: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    chunks_total: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    chunks_done: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
 
 
 class DocumentChunk(ModelBase):
@@ -22,9 +33,18 @@ class DocumentChunk(ModelBase):
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     document_id: Mapped[int] = mapped_column(Integer, ForeignKey(Document.id, ondelete="CASCADE"), nullable=False)
-    context: Mapped[str] = mapped_column(String, nullable=False)
+    # chunks are created up front and filled in as chunking progresses: context once hydrated, embedding once embedded
+    position: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    context: Mapped[str | None] = mapped_column(String, nullable=True)
     chunk: Mapped[str] = mapped_column(String, nullable=False)
-    embedding: Mapped[Vector] = mapped_column(Vector(EMBED_DIM), nullable=False)
+    content_hash: Mapped[str | None] = mapped_column(String(64), nullable=True)
+    embedding: Mapped[Vector | None] = mapped_column(Vector(EMBED_DIM), nullable=True)
+
+Index(
+    "ix_document_chunks_document_id_position",
+    DocumentChunk.document_id,
+    DocumentChunk.position,
+)
 
 Index(
     "ix_documents_embedding_hnsw_cos",
@@ -32,4 +52,50 @@ Index(
     postgresql_using="hnsw",
     postgresql_ops={"embedding": "vector_cosine_ops"},
     postgresql_with={"m": 16, "ef_construction": 200},
-)
\ No newline at end of file
+)
+
+class RateLimitLedger(ModelBase):
+    """
+    Shared OpenAI usage for the postgres rate limiter backend. One row per reservation, rows older than the window are purged.
+    """
+    __tablename__ = "rate_limit_ledger"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    model: Mapped[str] = mapped_column(String, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, server_default=func.clock_timestamp())
+    num_tokens: Mapped[int] = mapped_column(Integer, nullable=False)
+    num_requests: Mapped[int] = mapped_column(Integer, nullable=False, default=1)
+
+Index(
+    "ix_rate_limit_ledger_model_created_at",
+    RateLimitLedger.model,
+    RateLimitLedger.created_at,
+)
+
+class ResponseCacheEntry(ModelBase):
+    """
+    Persistent tier of the LLM response cache, keyed by the hash of everything that determines a response.
+    """
+    __tablename__ = "response_cache"
+
+    key: Mapped[str] = mapped_column(String(64), primary_key=True)
+    model: Mapped[str] = mapped_column(String, nullable=False)
+    payload: Mapped[str] = mapped_column(String, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    accessed_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+Index(
+    "ix_response_cache_accessed_at",
+    ResponseCacheEntry.accessed_at,
+)
+
+class EmbeddingCacheEntry(ModelBase):
+    """
+    Persistent tier of the embedding cache, keyed by the hash of the model and the normalized text.
+    """
+    __tablename__ = "embedding_cache"
+
+    key: Mapped[str] = mapped_column(String(64), primary_key=True)
+    model: Mapped[str] = mapped_column(String, nullable=False)
+    embedding: Mapped[Vector] = mapped_column(Vector(EMBED_DIM), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, server_default=func.now())
@@ -1,12 +1,21 @@
-from http.client import PROCESSING
+import numpy as np
 from pgvector.sqlalchemy import Vector
-from sqlalchemy import Integer, cast, column, desc, func, select, true, union_all, update, values
+from sqlalchemy import Integer, cast, column, delete, desc, func, literal, select, text, true, union_all, update, values
 import sqlalchemy
+from sqlalchemy.dialects.postgresql import insert
+import sqlalchemy.ext.asyncio
 import sqlalchemy.orm
 
 from src.ai.models import EMBED_DIM
-from src.services.schema import ChunkingStage, DocumentChunkCreate, DocumentChunkRead, DocumentChunkSimilarityRead, DocumentChunkUpdate, DocumentCreate, DocumentUpdate
-from src.db.models import Document, DocumentChunk
+from src.ai.processing import get_content_hash
+from src.env import settings
+from src.services.schema import ChunkingStage, DocumentChunkCreate, DocumentChunkUpdate, DocumentCreate, DocumentUpdate, SimilaritySearchMode
+from src.db.models import Document, DocumentChunk, EmbeddingCacheEntry, RateLimitLedger, ResponseCacheEntry
+
+_COPY_RESULTS_SQL = "COPY _chunk_results (id, context, embedding) FROM STDIN WITH (FORMAT BINARY)"
+_COPY_RESULTS_TYPES = ["int4", "text", "vector"]
+
+CHUNKING_CHANNEL = "document_chunking"      # NOTIFY channel the chunking workers LISTEN on
 
 class DocumentNotFoundError(Exception):
     """
@@ -16,6 +25,23 @@ class DocumentNotFoundError(Exception):
         super().__init__(f"Document with ID {document_id} not found.")
         self.document_id = document_id
 
+class DuplicateDocumentError(Exception):
+    """
+    Exception raised when a document with the same content already exists and duplicates are rejected.
+    """
+    def __init__(self, document_id: int):
+        super().__init__(f"Document with ID {document_id} has the same content.")
+        self.document_id = document_id
+
+class ChunkingClaimLostError(Exception):
+    """
+    Exception raised when a chunking run writes after its document was requeued (edited, resumed) or claimed by another worker.
+    """
+    def __init__(self, document_id: int, claim: int):
+        super().__init__(f"Chunking claim {claim} on document with ID {document_id} is no longer current.")
+        self.document_id = document_id
+        self.claim = claim
+
 class DocumentChunkNotFoundError(Exception):
     """
     Exception raised when a document chunk is not found.
@@ -24,6 +50,182 @@ class DocumentChunkNotFoundError(Exception):
         super().__init__(f"Document chunk with ID {chunk_id} not found.")
         self.chunk_id = chunk_id
 
+# statement builders shared by the sync and async repositories
+
+def _copy_result_row(result: dict) -> tuple:
+    embedding = result.get("embedding")
+    return (result["id"], result.get("context"), np.asarray(embedding, dtype=np.float32) if embedding is not None else None)
+
+def _ef_search_stmt(ef_search: int | None, limit: int):
+    """
+    hnsw.ef_search is transaction scoped so it never leaks into other sessions in the pool.
+    """
+    return text(f"SET LOCAL hnsw.ef_search = {int(max(ef_search or settings.HNSW_EF_SEARCH, limit))}")
+
+def _similarities_sq(embeddings: list[list[float]], limit: int, mode: SimilaritySearchMode):
+    """
+    Builds the (id, similarity) subquery for the requested search mode.
+    """
+
+    if mode == SimilaritySearchMode.EXACT:
+        return _exact_similarities_sq(embeddings, limit)
+
+    return _indexed_similarities_sq(embeddings, limit)
+
+def _indexed_similarities_sq(embeddings: list[list[float]], limit: int):
+    """
+    One top-k per query embedding. Each branch orders by `embedding <=> constant` so the planner can use the hnsw index.
+    The branches are then merged keeping the min distance per chunk.
+    """
+
+    per_query = []
+    for embedding in embeddings:
+        distance = DocumentChunk.embedding.cosine_distance(embedding)
+        per_query.append(
+            select(
+                DocumentChunk.id,
+                distance.label("similarity")
+            )
+            .where(DocumentChunk.embedding.is_not(None))
+            .order_by(distance)
+            .limit(limit)
+        )
+
+    crossed = union_all(*per_query).subquery()
+
+    best = (
+        select(
+            crossed.c.id,
+            func.min(crossed.c.similarity).label("similarity")
+        )
+        .group_by(crossed.c.id)
+        .subquery()
+    )
+
+    return best
+
+def _exact_similarities_sq(embeddings: list[list[float]], limit: int):
+    """
+    Exact search. Cross joins the question embeddings against every chunk, this can not use the hnsw index.
+    """
+
+    # build the temp table with question embeddings
+    v = (
+        values(
+            column("q_idx", Integer),
+            column("q_embedding", Vector(EMBED_DIM))
+        )
+        .data((i, embedding) for i, embedding in enumerate(embeddings))
+        .alias()
+    )
+
+    # cross join the question embeddings with the 
+    crossed = (
+        select(
+            DocumentChunk.id, 
+            DocumentChunk.embedding.cosine_distance( cast(v.c.q_embedding, Vector(EMBED_DIM)) ).label("similarity")
+        )
+        .select_from(
+            v.join(
+                DocumentChunk,
+                true(),
+            )
+        )
+        .where(DocumentChunk.embedding.is_not(None))
+        .order_by("similarity")
+        .limit(limit * len(embeddings))
+        .subquery()
+    )
+        
+    best = (
+        select(
+            crossed.c.id,
+            func.min(crossed.c.similarity).label("similarity")
+        )
+        .group_by(crossed.c.id)    
+        .subquery()                    
+    )
+
+    return best
+
+def _similarities_stmt(best, limit: int):
+    return (
+        select(DocumentChunk, best.c.similarity)
+        .join(best, DocumentChunk.id == best.c.id)
+        .order_by(best.c.similarity)
+        .limit(limit)
+    )
+
+def _similarity_projections_stmt(best, limit: int):
+    return (
+        select(
+            DocumentChunk.id,
+            DocumentChunk.document_id,
+            DocumentChunk.context,
+            DocumentChunk.chunk,
+            best.c.similarity,
+        )
+        .join(best, DocumentChunk.id == best.c.id)
+        .order_by(best.c.similarity)
+        .limit(limit)
+    )
+
+def _lease_expiry(lease_seconds: float):
+    return func.now() + func.make_interval(0, 0, 0, 0, 0, 0, lease_seconds)
+
+def _next_chunking_stmt(lease_seconds: float, max_attempts: int):
+    """
+    Claim the oldest document waiting for chunking, or one whose worker stopped renewing its lease (crashed, killed).
+    Failed documents are retried up to `max_attempts` times, once their lease ran out. Chunking resumes where it stopped.
+    A document requeued while it was being chunked keeps its lease, so it is only claimed again once the previous run stopped.
+    Every claim bumps chunking_claim, the returned value is the token the run writes with. Duplicates are never claimed.
+    """
+    lease_expired = Document.lease_expires_at.is_(None) | (Document.lease_expires_at < func.now())
+    stmt_sq = (
+        select(Document.id)
+        .where(
+            ((Document.chunking_stage == ChunkingStage.NOT_STARTED) & lease_expired)
+            | ((Document.chunking_stage == ChunkingStage.IN_PROGRESS) & lease_expired)
+            | ((Document.chunking_stage == ChunkingStage.FAILED) & lease_expired & (Document.chunking_attempts < max_attempts))
+        )
+        .where(Document.canonical_id.is_(None))
+        .order_by(Document.id)
+        .with_for_update(skip_locked=True)
+        .limit(1)
+        .subquery()
+    )
+
+    stmt = (
+        update(Document)
+        .where(Document.id == stmt_sq.c.id)
+        .values(
+            chunking_stage = ChunkingStage.IN_PROGRESS, 
+            lease_expires_at = _lease_expiry(lease_seconds), 
+            chunking_attempts = Document.chunking_attempts + 1,
+            chunking_claim = Document.chunking_claim + 1,
+        )
+        .returning(Document)
+        .execution_options(synchronize_session="fetch") 
+    )
+
+    return stmt
+
+def _mirror_stage_stmt(document_id: int, stage: ChunkingStage):
+    """
+    Duplicates report the chunking stage of the document whose chunks they share.
+    """
+    return update(Document).where(Document.canonical_id == document_id).values(chunking_stage = stage)
+
+def _holds_claim(document_id: int, claim: int):
+    return (Document.id == document_id) & (Document.chunking_claim == claim) & (Document.chunking_stage == ChunkingStage.IN_PROGRESS)
+
+def _renew_lease_stmt(document_id: int, claim: int, lease_seconds: float):
+    return (
+        update(Document)
+        .where(_holds_claim(document_id, claim))
+        .values(lease_expires_at = _lease_expiry(lease_seconds))
+    )
+
 class DocumentChunkRepository:
     """
     Document chunk repository for CRUD operations.
@@ -52,13 +254,13 @@ class DocumentChunkRepository:
         self.session.flush()
 
         return db_chunk
-    
+
     def update(self, chunk: DocumentChunkUpdate) -> DocumentChunk:
         """
         Update a document chunk in the database.
         """
 
-        db_chunk = self.session.get(Document, chunk.id)
+        db_chunk = self.session.get(DocumentChunk, chunk.id)
 
         if not db_chunk:
             raise DocumentChunkNotFoundError(chunk.id)
@@ -69,55 +271,27 @@ class DocumentChunkRepository:
         self.session.flush()
         return db_chunk
     
-    def  get_similarities(self, embeddings: list[list[float]], limit = 10) -> list[tuple[DocumentChunk, float]]:
+    def get_similarities(self, embeddings: list[list[float]], limit = 10, mode: SimilaritySearchMode = SimilaritySearchMode.INDEXED, ef_search: int | None = None) -> list[tuple[DocumentChunk, float]]:
         """
         accepts a list of embeddings and returns the closest matching chunks
         """
 
-        # build the temp table with question embeddings
-        v = (
-            values(
-                column("q_idx", Integer),
-                column("q_embedding", Vector(EMBED_DIM))
-            )
-            .data((i, embedding) for i, embedding in enumerate(embeddings))
-            .alias()
-        )
+        if mode == SimilaritySearchMode.INDEXED:
+            self.session.execute(_ef_search_stmt(ef_search, limit))
 
-        # cross join the question embeddings with the 
-        crossed = (
-            select(
-                DocumentChunk.id, 
-                DocumentChunk.embedding.cosine_distance( cast(v.c.q_embedding, Vector(EMBED_DIM)) ).label("similarity")
-            )
-            .select_from(
-                v.join(
-                    DocumentChunk,
-                    true(),
-                )
-            )
-            .order_by("similarity")
-            .limit(limit * len(embeddings))
-            .subquery()
-        )
-            
-        best = (
-            select(
-                crossed.c.id,
-                func.min(crossed.c.similarity).label("similarity")
-            )
-            .group_by(crossed.c.id)    
-            .subquery()                    
-        )
+        best = _similarities_sq(embeddings, limit, mode)
+        return self.session.execute(_similarities_stmt(best, limit)).all()
 
-        final = (
-            select(DocumentChunk, best.c.similarity)
-            .join(best, DocumentChunk.id == best.c.id)
-            .order_by(best.c.similarity)
-            .limit(limit)
-        )
+    def explain_similarities(self, embeddings: list[list[float]], limit = 10, mode: SimilaritySearchMode = SimilaritySearchMode.INDEXED) -> list[str]:
+        """
+        Returns the query plan of the similarity search. Used to verify the hnsw index is hit.
+        """
 
-        return self.session.execute(final).all()
+        best = _similarities_sq(embeddings, limit, mode)
+        sql = select(best.c.id, best.c.similarity).order_by(best.c.similarity).limit(limit)
+        compiled = sql.compile(self.session.get_bind(), compile_kwargs={"literal_binds": True})
+
+        return self.session.execute(text(f"EXPLAIN {compiled}")).scalars().all()
     
     
 
@@ -150,31 +324,6 @@ class DocumentRepository:
             raise DocumentNotFoundError(document_id)
         return result
 
-    def get_next_chunking(self,) -> Document | None:
-        """
-        Get the next document to process for chunking
-        """
-
-        stmt_sq = (
-            select(Document.id)
-            .where(Document.chunking_stage == ChunkingStage.NOT_STARTED)
-            .with_for_update(skip_locked=True)
-            .limit(1)
-            .subquery()
-        )
-
-        stmt = (
-            update(Document)
-            .where(Document.id == stmt_sq.c.id)
-            .values(chunking_stage = ChunkingStage.IN_PROGRESS)
-            .returning(Document)
-            .execution_options(synchronize_session="fetch") 
-        )
-
-        r = self.session.execute(stmt)
-        document = r.scalars().first()
-        return document
-
     def update(self, document: DocumentUpdate) -> Document:
         """
         Update a document in the database.
@@ -212,4 +361,630 @@ class DocumentRepository:
             raise DocumentNotFoundError(document_id)
         
         self.session.delete(db_doc)
-        self.session.flush()        
\ No newline at end of file
+        self.session.flush()        
+
+class AsyncDocumentChunkRepository:
+    """
+    Async version of DocumentChunkRepository.
+    """
+
+    def __init__(self, session: sqlalchemy.ext.asyncio.AsyncSession):
+        self.session = session
+
+    async def get(self, chunk_id: int) -> DocumentChunk:
+        """
+        Get a document chunk by its ID.
+        """
+
+        result = await self.session.get(DocumentChunk, chunk_id)
+        if not result:
+            raise DocumentChunkNotFoundError(chunk_id)
+        return result
+
+    async def create(self, chunk: DocumentChunkCreate) -> DocumentChunk:
+        """
+        Insert a document chunk into the database.
+        """
+
+        db_chunk = DocumentChunk(**chunk.model_dump())
+        self.session.add(db_chunk)
+        await self.session.flush()
+
+        return db_chunk
+
+    async def update(self, chunk: DocumentChunkUpdate) -> DocumentChunk:
+        """
+        Update a document chunk in the database.
+        """
+
+        db_chunk = await self.session.get(DocumentChunk, chunk.id)
+
+        if not db_chunk:
+            raise DocumentChunkNotFoundError(chunk.id)
+
+        for key, value in chunk.model_dump(exclude={"id"}, exclude_unset=True).items():
+            setattr(db_chunk, key, value)
+
+        await self.session.flush()
+        return db_chunk
+
+    async def get_progress(self, document_id: int) -> list[sqlalchemy.Row]:
+        """
+        The chunks of a document in order: (id, position, content_hash, context, embedded). Neither the chunk text nor the embedding is loaded.
+        """
+
+        r = await self.session.execute(
+            select(
+                DocumentChunk.id,
+                DocumentChunk.position,
+                DocumentChunk.content_hash,
+                DocumentChunk.context,
+                DocumentChunk.embedding.is_not(None).label("embedded"),
+            )
+            .where(DocumentChunk.document_id == document_id)
+            .order_by(DocumentChunk.position, DocumentChunk.id)
+        )
+        return r.all()
+
+    async def backfill_content_hashes(self) -> int:
+        """
+        Hash the chunks created before chunk content hashes existed. Returns the number of chunks hashed.
+        """
+        r = await self.session.execute(
+            update(DocumentChunk)
+            .where(DocumentChunk.content_hash.is_(None))
+            .values(content_hash = func.encode(func.sha256(func.convert_to(DocumentChunk.chunk, "UTF8")), "hex"))
+        )
+        return r.rowcount
+
+    async def create_pending(self, document_id: int, chunks: dict[int, str]) -> None:
+        """
+        Insert chunks of a document, keyed by position, without context or embedding. These are filled in with save_results.
+        """
+
+        if not chunks:
+            return
+
+        await self.session.execute(
+            insert(DocumentChunk),
+            [
+                {"document_id": document_id, "position": i, "chunk": chunk, "content_hash": get_content_hash(chunk)} 
+                for i, chunk in chunks.items()
+            ],
+        )
+
+    async def update_many(self, values: list[dict]) -> None:
+        """
+        Bulk update by primary key, each dict holds the chunk `id` and the columns to set. 
+        Meant for small columns like position, contexts and embeddings go through save_results.
+        """
+
+        if values:
+            await self.session.execute(update(DocumentChunk), values)
+
+    async def save_results(self, results: list[dict]) -> None:
+        """
+        Write the context and/or embedding of chunks, each dict holds the chunk `id` and the columns to set.
+        The rows go through a binary COPY into a temp table and a single UPDATE ... FROM, so embeddings are sent 
+        as float32 instead of text. A column missing from a dict is left as is.
+        """
+
+        if not results:
+            return
+
+        await self.session.execute(text("CREATE TEMP TABLE _chunk_results (id int4 PRIMARY KEY, context text, embedding vector) ON COMMIT DROP"))
+
+        # raw psycopg async connection participating in the session's transaction, pgvector is registered on it by the engine
+        conn = await self.session.connection()
+        raw = await conn.get_raw_connection()
+        driver_conn = raw.driver_connection
+
+        async with driver_conn.cursor() as cursor:
+            async with cursor.copy(_COPY_RESULTS_SQL) as copy:
+                copy.set_types(_COPY_RESULTS_TYPES)
+                for result in results:
+                    await copy.write_row(_copy_result_row(result))
+
+        await self.session.execute(text("""
+            UPDATE document_chunks AS c
+            SET context = COALESCE(r.context, c.context), embedding = COALESCE(r.embedding, c.embedding)
+            FROM _chunk_results AS r
+            WHERE c.id = r.id
+        """))
+        await self.session.execute(text("DROP TABLE _chunk_results"))
+
+    async def delete_many(self, chunk_ids: list[int]) -> None:
+        """
+        Delete chunks by ID.
+        """
+
+        if chunk_ids:
+            await self.session.execute(delete(DocumentChunk).where(DocumentChunk.id.in_(chunk_ids)))
+
+    async def get_similarities(self, embeddings: list[list[float]], limit = 10, mode: SimilaritySearchMode = SimilaritySearchMode.INDEXED, ef_search: int | None = None) -> list[tuple[DocumentChunk, float]]:
+        """
+        accepts a list of embeddings and returns the closest matching chunks
+        """
+
+        if mode == SimilaritySearchMode.INDEXED:
+            await self.session.execute(_ef_search_stmt(ef_search, limit))
+
+        best = _similarities_sq(embeddings, limit, mode)
+        r = await self.session.execute(_similarities_stmt(best, limit))
+        return r.all()
+
+    async def get_similarity_projections(self, embeddings: list[list[float]], limit = 10, mode: SimilaritySearchMode = SimilaritySearchMode.INDEXED, ef_search: int | None = None) -> list[sqlalchemy.Row]:
+        """
+        Same as get_similarities but only selects the columns needed to build a prompt. 
+        The embedding never leaves the db.
+        """
+
+        if mode == SimilaritySearchMode.INDEXED:
+            await self.session.execute(_ef_search_stmt(ef_search, limit))
+
+        best = _similarities_sq(embeddings, limit, mode)
+        r = await self.session.execute(_similarity_projections_stmt(best, limit))
+        return r.all()
+
+class AsyncDocumentRepository:
+    """
+    Async version of DocumentRepository.
+    """
+
+    def __init__(self, session: sqlalchemy.ext.asyncio.AsyncSession):
+        self.session = session
+
+    async def get_all(self) -> list[Document]:
+        """
+        Get all documents from the database.
+        """
+
+        r = await self.session.execute(select(Document))
+        return r.scalars().all()
+
+    async def get(self, document_id: int) -> Document:
+        """
+        Get a document by its ID.
+        """
+
+        result = await self.session.get(Document, document_id)
+        if not result:
+            raise DocumentNotFoundError(document_id)
+        return result
+
+    async def get_next_chunking(self, lease_seconds: float = settings.CHUNKING_LEASE_SECONDS, max_attempts: int = settings.CHUNKING_MAX_ATTEMPTS) -> Document | None:
+        """
+        Get the next document to process for chunking, leased for `lease_seconds`.
+        """
+
+        r = await self.session.execute(_next_chunking_stmt(lease_seconds, max_attempts))
+        document = r.scalars().first()
+        if document is not None:
+            await self.session.execute(_mirror_stage_stmt(document.id, ChunkingStage.IN_PROGRESS))
+        return document
+
+    async def renew_lease(self, document_id: int, claim: int, lease_seconds: float = settings.CHUNKING_LEASE_SECONDS) -> bool:
+        """
+        Heartbeat of the worker chunking the document. Returns whether `claim` still holds the document.
+        """
+        r = await self.session.execute(_renew_lease_stmt(document_id, claim, lease_seconds))
+        return r.rowcount > 0
+
+    async def hold_claim(self, document_id: int, claim: int) -> None:
+        """
+        Lock the document for the rest of the transaction, provided `claim` still holds it. Raises ChunkingClaimLostError otherwise.
+        A requeue waits for the lock, so the writes of the run made in the same transaction can not land after it.
+        """
+        r = await self.session.execute(select(Document.id).where(_holds_claim(document_id, claim)).with_for_update())
+        if r.first() is None:
+            raise ChunkingClaimLostError(document_id, claim)
+
+    async def refresh_progress(self, document_id: int) -> None:
+        """
+        Recount the embedded chunks of the document into chunks_done. Only safe while nothing else writes its chunks, see add_progress.
+        """
+        done = (
+            select(func.count())
+            .select_from(DocumentChunk)
+            .where(DocumentChunk.document_id == document_id)
+            .where(DocumentChunk.embedding.is_not(None))
+            .scalar_subquery()
+        )
+        await self.session.execute(update(Document).where(Document.id == document_id).values(chunks_done = done))
+
+    async def add_progress(self, document_id: int, claim: int, n_chunks: int) -> None:
+        """
+        Count `n_chunks` newly embedded chunks into chunks_done. An increment rather than a recount, checkpoints commit concurrently.
+        Holds the claim like hold_claim, raises ChunkingClaimLostError if it is lost.
+        """
+        r = await self.session.execute(
+            update(Document)
+            .where(_holds_claim(document_id, claim))
+            .values(chunks_done = Document.chunks_done + n_chunks)
+        )
+        if r.rowcount == 0:
+            raise ChunkingClaimLostError(document_id, claim)
+
+    async def finish_chunking(self, document_id: int, claim: int, stage: ChunkingStage) -> bool:
+        """
+        Record the outcome of the run holding `claim`, unless the document was requeued (edited, resumed) or reclaimed meanwhile. 
+        Returns whether it was recorded.
+        """
+        r = await self.session.execute(
+            update(Document)
+            .where(_holds_claim(document_id, claim))
+            .values(chunking_stage = stage)
+        )
+        if r.rowcount == 0:
+            return False
+
+        await self.session.execute(_mirror_stage_stmt(document_id, stage))
+        return True
+
+    async def release_lease(self, document_id: int) -> bool:
+        """
+        Drop the lease a requeued document kept from the run that was chunking it, once that run stopped,
+        so it can be claimed right away. Returns whether there was one to drop.
+        """
+        r = await self.session.execute(
+            update(Document)
+            .where(Document.id == document_id)
+            .where(Document.chunking_stage == ChunkingStage.NOT_STARTED)
+            .where(Document.lease_expires_at.is_not(None))
+            .values(lease_expires_at = None)
+        )
+        return r.rowcount > 0
+
+    async def requeue(self, document_id: int) -> Document:
+        """
+        Queue a document for chunking again with a fresh set of attempts. Chunks already done are kept.
+        A run in progress loses its claim. Its lease is kept so no other worker starts before it stopped, see finish_chunking.
+        """
+        await self.session.flush()
+        r = await self.session.execute(
+            select(Document)
+            .where(Document.id == document_id)
+            .with_for_update()
+            .execution_options(populate_existing=True)
+        )
+        db_doc = r.scalars().first()
+        if not db_doc:
+            raise DocumentNotFoundError(document_id)
+
+        if db_doc.chunking_stage != ChunkingStage.IN_PROGRESS:
+            db_doc.lease_expires_at = None
+        db_doc.chunking_stage = ChunkingStage.NOT_STARTED
+        db_doc.chunking_attempts = 0
+        db_doc.chunking_claim += 1
+        await self.session.execute(_mirror_stage_stmt(document_id, ChunkingStage.NOT_STARTED))
+
+        await self.session.flush()
+        return db_doc
+
+    async def lock_content(self, content_hash: str) -> None:
+        """
+        Serialize the dedup check of documents with the same content. Released on commit/rollback.
+        """
+        await self.session.execute(select(func.pg_advisory_xact_lock(func.hashtext(f"document:{content_hash}"))))
+
+    async def get_canonical(self, content_hash: str, exclude_id: int | None = None) -> Document | None:
+        """
+        The oldest document with this content that owns its chunks.
+        """
+        stmt = (
+            select(Document)
+            .where(Document.content_hash == content_hash)
+            .where(Document.canonical_id.is_(None))
+            .order_by(Document.id)
+            .limit(1)
+        )
+        if exclude_id is not None:
+            stmt = stmt.where(Document.id != exclude_id)
+
+        r = await self.session.execute(stmt)
+        return r.scalars().first()
+
+    async def link(self, document_id: int, canonical_id: int) -> Document:
+        """
+        Make a document a duplicate of `canonical_id`: its own chunks are dropped and there is nothing left to chunk.
+        It reports the chunking stage of the canonical document from then on.
+        A run in progress loses its claim and lease, like requeue. Duplicates of the document itself are re-pointed at `canonical_id`, no chains.
+        """
+        await self.session.flush()
+        r = await self.session.execute(
+            select(Document)
+            .where(Document.id == document_id)
+            .with_for_update()
+            .execution_options(populate_existing=True)
+        )
+        db_doc = r.scalars().first()
+        if not db_doc:
+            raise DocumentNotFoundError(document_id)
+
+        await self.session.execute(delete(DocumentChunk).where(DocumentChunk.document_id == document_id))
+
+        canonical = await self.get(canonical_id)
+        db_doc.canonical_id = canonical_id
+        db_doc.chunking_stage = canonical.chunking_stage
+        db_doc.chunks_total = None
+        db_doc.chunks_done = 0
+        db_doc.lease_expires_at = None
+        db_doc.chunking_claim += 1
+
+        await self.session.execute(
+            update(Document)
+            .where(Document.canonical_id == document_id)
+            .values(canonical_id = canonical_id, chunking_stage = canonical.chunking_stage)
+        )
+
+        await self.session.flush()
+        return db_doc
+
+    async def release_duplicates(self, document_id: int, move_chunks: bool) -> int | None:
+        """
+        Called before a canonical document changes content (`move_chunks` False) or is deleted (`move_chunks` True). 
+        The oldest duplicate becomes the new canonical, the others now point at it. Returns the ID of the new canonical, if any.
+
+        The new canonical takes over the chunks, moved when the document goes away and copied when it keeps them for its own re-index.
+        It is queued for chunking, which matches them by content hash and only processes the chunks that differ (the title).
+        """
+        r = await self.session.execute(
+            select(Document)
+            .where(Document.canonical_id == document_id)
+            .order_by(Document.id)
+        )
+        duplicates = r.scalars().all()
+        if not duplicates:
+            return None
+
+        promoted, *others = duplicates
+        promoted.canonical_id = None
+        promoted.chunking_stage = ChunkingStage.NOT_STARTED
+        promoted.chunking_attempts = 0
+        for it in others:
+            it.canonical_id = promoted.id
+            it.chunking_stage = ChunkingStage.NOT_STARTED
+
+        if move_chunks:
+            await self.session.execute(
+                update(DocumentChunk)
+                .where(DocumentChunk.document_id == document_id)
+                .values(document_id = promoted.id)
+            )
+        else:
+            columns = [DocumentChunk.position, DocumentChunk.context, DocumentChunk.chunk, DocumentChunk.content_hash, DocumentChunk.embedding]
+            await self.session.execute(
+                insert(DocumentChunk).from_select(
+                    [DocumentChunk.document_id, *columns],
+                    select(literal(promoted.id), *columns).where(DocumentChunk.document_id == document_id),
+                )
+            )
+
+        await self.session.flush()
+        return promoted.id
+
+    async def backfill_content_hashes(self) -> int:
+        """
+        Hash the content of the documents created before content hashes existed. Returns the number of documents hashed.
+        """
+        r = await self.session.execute(
+            update(Document)
+            .where(Document.content_hash.is_(None))
+            .values(content_hash = func.encode(func.sha256(func.convert_to(Document.content, "UTF8")), "hex"))
+        )
+        return r.rowcount
+
+    async def get_duplicate_groups(self) -> list[list[Document]]:
+        """
+        Canonical documents sharing their content with another canonical document, grouped by content.
+        """
+        duplicated = (
+            select(Document.content_hash)
+            .where(Document.canonical_id.is_(None))
+            .where(Document.content_hash.is_not(None))
+            .group_by(Document.content_hash)
+            .having(func.count() > 1)
+        )
+        r = await self.session.execute(
+            select(Document)
+            .where(Document.canonical_id.is_(None))
+            .where(Document.content_hash.in_(duplicated))
+            .order_by(Document.content_hash, Document.id)
+        )
+
+        groups: dict[str, list[Document]] = {}
+        for it in r.scalars().all():
+            groups.setdefault(it.content_hash, []).append(it)
+        return list(groups.values())
+
+    async def notify_chunking(self, document_id: int) -> None:
+        """
+        Wake the chunking workers. Delivered when the transaction commits.
+        """
+        await self.session.execute(select(func.pg_notify(CHUNKING_CHANNEL, str(document_id))))
+
+    async def update(self, document: DocumentUpdate) -> Document:
+        """
+        Update a document in the database.
+        """
+
+        db_doc = await self.session.get(Document, document.id)
+
+        if not db_doc:
+            raise DocumentNotFoundError(document.id)
+
+        for key, value in document.model_dump(exclude={"id"}, exclude_unset=True).items():
+            setattr(db_doc, key, value)
+        if document.content is not None:
+            db_doc.content_hash = get_content_hash(document.content)
+
+        await self.session.flush()
+        return db_doc
+
+    async def create(self, document: DocumentCreate) -> Document:
+        """
+        Insert a document into the database.
+        """
+
+        db_doc = Document(**document.model_dump(), content_hash = get_content_hash(document.content))
+        self.session.add(db_doc)
+
+        await self.session.flush()
+        return db_doc
+
+    async def delete(self, document_id: int) -> None:
+        """
+        Delete a document from the database.
+        """
+        db_doc = await self.session.get(Document, document_id)
+
+        if not db_doc:
+            raise DocumentNotFoundError(document_id)
+
+        await self.session.delete(db_doc)
+        await self.session.flush()
+class AsyncRateLimitRepository:
+    """
+    Ledger backing the cross process rate limiter. Every method is meant to run inside a transaction holding `lock` for the model.
+    """
+
+    def __init__(self, session: sqlalchemy.ext.asyncio.AsyncSession):
+        self.session = session
+
+    async def lock(self, model: str) -> None:
+        """
+        Serialize all processes reserving capacity on the same model. Released on commit/rollback.
+        """
+        await self.session.execute(select(func.pg_advisory_xact_lock(func.hashtext(f"rate_limit:{model}"))))
+
+    async def purge(self, model: str, window: float) -> None:
+        """
+        Drop the reservations that left the window.
+        """
+        await self.session.execute(
+            delete(RateLimitLedger)
+            .where(RateLimitLedger.model == model)
+            .where(RateLimitLedger.created_at <= func.clock_timestamp() - func.make_interval(0, 0, 0, 0, 0, 0, window))
+        )
+
+    async def get_usage(self, model: str, window: float) -> tuple[int, int, float | None]:
+        """
+        Returns the tokens and requests in the window, and the seconds until the oldest reservation expires.
+        """
+        r = await self.session.execute(
+            select(
+                func.coalesce(func.sum(RateLimitLedger.num_tokens), 0),
+                func.coalesce(func.sum(RateLimitLedger.num_requests), 0),
+                func.date_part("epoch", func.min(RateLimitLedger.created_at) + func.make_interval(0, 0, 0, 0, 0, 0, window) - func.clock_timestamp()),
+            )
+            .where(RateLimitLedger.model == model)
+        )
+        tokens, requests, expires_in = r.one()
+        return int(tokens), int(requests), None if expires_in is None else float(expires_in)
+
+    async def create(self, model: str, num_tokens: int, num_requests: int = 1) -> RateLimitLedger:
+        """
+        Record a reservation.
+        """
+        db_item = RateLimitLedger(model = model, num_tokens = num_tokens, num_requests = num_requests)
+        self.session.add(db_item)
+        await self.session.flush()
+        return db_item
+
+    async def update_tokens(self, ledger_id: int, num_tokens: int) -> None:
+        """
+        Settle a reservation with the actual usage. No-op if it was already purged.
+        """
+        await self.session.execute(
+            update(RateLimitLedger)
+            .where(RateLimitLedger.id == ledger_id)
+            .values(num_tokens = num_tokens)
+        )
+
+class AsyncResponseCacheRepository:
+    """
+    Persistent tier of the LLM response cache.
+    """
+
+    def __init__(self, session: sqlalchemy.ext.asyncio.AsyncSession):
+        self.session = session
+
+    async def get(self, key: str, ttl: float) -> str | None:
+        """
+        Returns the cached payload if it is younger than `ttl` seconds, and marks it as recently used.
+        """
+        r = await self.session.execute(
+            update(ResponseCacheEntry)
+            .where(ResponseCacheEntry.key == key)
+            .where(ResponseCacheEntry.created_at > func.now() - func.make_interval(0, 0, 0, 0, 0, 0, ttl))
+            .values(accessed_at = func.now())
+            .returning(ResponseCacheEntry.payload)
+        )
+        return r.scalar_one_or_none()
+
+    async def put(self, key: str, model: str, payload: str) -> None:
+        """
+        Insert or refresh an entry.
+        """
+        stmt = insert(ResponseCacheEntry).values(key = key, model = model, payload = payload)
+        await self.session.execute(
+            stmt.on_conflict_do_update(
+                index_elements = [ResponseCacheEntry.key],
+                set_ = {"payload": stmt.excluded.payload, "created_at": func.now(), "accessed_at": func.now()},
+            )
+        )
+
+    async def evict(self, ttl: float, max_entries: int) -> int:
+        """
+        Drop the expired entries, then the least recently used ones above `max_entries`. Returns the number of rows deleted.
+        """
+        expired = await self.session.execute(
+            delete(ResponseCacheEntry)
+            .where(ResponseCacheEntry.created_at <= func.now() - func.make_interval(0, 0, 0, 0, 0, 0, ttl))
+        )
+
+        keep = (
+            select(ResponseCacheEntry.key)
+            .order_by(desc(ResponseCacheEntry.accessed_at))
+            .limit(max_entries)
+        )
+        overflow = await self.session.execute(
+            delete(ResponseCacheEntry)
+            .where(ResponseCacheEntry.key.not_in(keep.scalar_subquery()))
+        )
+        return expired.rowcount + overflow.rowcount
+
+class AsyncEmbeddingCacheRepository:
+    """
+    Persistent tier of the embedding cache.
+    """
+
+    def __init__(self, session: sqlalchemy.ext.asyncio.AsyncSession):
+        self.session = session
+
+    async def get_many(self, keys: list[str]) -> dict[str, np.ndarray]:
+        """
+        Returns the cached embeddings of the given keys, missing keys are left out.
+        """
+        if not keys:
+            return {}
+
+        r = await self.session.execute(
+            select(EmbeddingCacheEntry.key, EmbeddingCacheEntry.embedding)
+            .where(EmbeddingCacheEntry.key.in_(keys))
+        )
+        return {key: np.asarray(embedding, dtype=np.float32) for key, embedding in r.all()}
+
+    async def put_many(self, model: str, embeddings: dict[str, np.ndarray]) -> None:
+        """
+        Insert the embeddings, keys that are already cached are left alone.
+        """
+        if not embeddings:
+            return
+
+        await self.session.execute(
+            insert(EmbeddingCacheEntry)
+            .values([{"key": key, "model": model, "embedding": embedding} for key, embedding in embeddings.items()])
+            .on_conflict_do_nothing(index_elements = [EmbeddingCacheEntry.key])
+        )
+
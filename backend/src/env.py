@@ -1,3 +1,4 @@
+from typing import Literal
 from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -7,6 +8,39 @@ class Settings(BaseSettings):
     """
     OPENAI_API_KEY: str
     OPENAI_MAX_TOKENS_MIN: int = Field(200000, gt=0, description = "The per minute rate limit in tokens.")# https://platform.openai.com/settings/organization/limits
+    OPENAI_MAX_REQ_MIN: int = Field(20, gt=0, description = "The per minute rate limit in requests.")
+    RATE_LIMITER_BACKEND: Literal["memory", "postgres"] = Field("memory", description = "memory: per process limiter, the fast path for single process deployments. postgres: one budget shared by every process through the db.")
+    OPENAI_BASE_URL: str | None = Field(None, description = "Override the OpenAI api url, e.g. to point at a local fake server. Defaults to the public api.")
+
+    DATABASE_URL: str = Field("postgresql+psycopg://postgres:postgres@db:5432/ascertain", description = "SQLAlchemy url of the postgres db. psycopg is used for both the sync and async engines.")
+    DB_POOL_SIZE: int = Field(5, gt=0, description = "Number of connections kept open per engine.")
+    DB_MAX_OVERFLOW: int = Field(10, ge=0, description = "Number of connections allowed above DB_POOL_SIZE under load.")
+
+    HYDRATION_BATCH_SIZE: int = Field(8, gt=0, description = "Chunks hydrated per LLM call during chunking. 1 disables batching.")
+    INGESTION_DIRECT_MAX_TOKENS: int = Field(750, ge=0, description = "Documents up to this many tokens are embedded without hydration. 750 is two 400 token chunks overlapping by 50.")
+    INGESTION_BATCHED_MAX_TOKENS: int = Field(50000, ge=0, description = "Documents up to this many tokens are hydrated in batches, larger ones one chunk per call.")
+
+    DOCUMENT_DEDUP_POLICY: Literal["link", "unique", "off"] = Field("link", description = "What happens when a document with the same content as an existing one is posted. link: it shares the chunks of the existing one. unique: it is rejected. off: it is chunked again.")
+
+    CHUNKING_WORKERS: int = Field(4, ge=0, description = "Documents chunked concurrently per process. 0 disables the chunking worker.")
+    CHUNKING_LEASE_SECONDS: int = Field(300, gt=0, description = "A document in progress whose worker has not renewed its lease for this long is picked up again.")
+    CHUNKING_POLL_SECONDS: float = Field(30, gt=0, description = "Idle workers check for work this often on top of the NOTIFY wake ups, e.g. to reclaim expired leases.")
+    CHUNKING_MAX_ATTEMPTS: int = Field(3, gt=0, description = "Times a document is picked up for chunking before it stays FAILED. Each attempt resumes where the last one stopped.")
+    RUN_CHUNKING_WORKER: bool = Field(True, description = "Run the chunking worker inside the api process. Turn off when chunking runs in its own process (python -m src.worker).")
+    CHUNKING_PROCESS_POOL_SIZE: int = Field(0, ge=0, description = "Processes for the CPU bound chunking stages (chunking, token counting). 0 runs them on the event loop.")
+
+    RESPONSE_CACHE_SIZE: int = Field(256, ge=0, description = "LLM responses kept in the in memory cache. 0 disables the cache.")
+    RESPONSE_CACHE_BACKEND: Literal["memory", "postgres"] = Field("memory", description = "memory: in process LRU only. postgres: the LRU backed by the response_cache table, shared by every process.")
+    RESPONSE_CACHE_TTL_SECONDS: int = Field(7 * 24 * 3600, gt=0, description = "Age after which a cached LLM response is no longer served.")
+    RESPONSE_CACHE_MAX_ENTRIES: int = Field(10000, gt=0, description = "Rows kept in the response_cache table, least recently used are evicted first.")
+
+    EMBEDDING_CACHE_SIZE: int = Field(4096, ge=0, description = "Embeddings kept in the in memory cache. 0 disables the cache.")
+    EMBEDDING_CACHE_BACKEND: Literal["memory", "postgres"] = Field("memory", description = "memory: in process LRU only. postgres: the LRU backed by the embedding_cache table, shared by every process.")
+    EMBEDDING_BATCH_MAX_INPUTS: int = Field(2048, gt=0, le=2048, description = "Texts per embeddings request, larger batches are split. The api accepts at most 2048.")
+    EMBEDDING_BATCH_MAX_TOKENS: int = Field(100000, gt=0, le=300000, description = "Tokens per embeddings request, larger batches are split. The api accepts at most 300k.")
+    EMBEDDING_COALESCE_WINDOW_MS: float = Field(5, ge=0, description = "Concurrent embedding requests arriving within this window are merged into one api call. 0 disables coalescing.")
+
+    HNSW_EF_SEARCH: int = Field(100, gt=0, le=1000, description = "Size of the dynamic candidate list used by hnsw index scans. Must be >= the similarity search limit.")
 
     model_config = SettingsConfigDict(
         env_file="env",
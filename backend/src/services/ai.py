@@ -1,40 +1,55 @@
 import asyncio
 from pathlib import Path
 from pprint import pprint
+import re
+from typing import AsyncIterator, Awaitable, Callable, Iterable
 from fhir.resources.patient import Patient
 from fhir.resources.condition import Condition
 from fhir.resources.medicationstatement import MedicationStatement
 from fhir.resources.bundle import Bundle
 
 from src.services.coders import run_code_lookup_action
-from src.services.documents import get_next_chunking_document, get_similar_chunks, update_document
+from src.services.documents import finish_chunking, get_document_chunks, get_next_chunking_document, get_similar_chunks, listen_for_chunking, reindex_document_chunks, renew_chunking_lease, save_chunking_plan, save_document_chunks
+from src.db.repositories import ChunkingClaimLostError
 from src.ai.models import Models
-from src.ai.processing import generate_naive_chunks
-from src.db.engine import UnitOfWork
-from src.services.schema import AIQuestionVariantsResponse, AIRagContextHydrationResponse, AIRagResponse, ChunkingStage, CodeLookupAction, CodeLookupActions, CodeSystem, DocumentChunkCreate, DocumentRead, DocumentUpdate, DumbStructuredNote, MedicalConcept, MedicalConcepts
+from src.ai.rate_limiter import Priority
+from src.ai.usage import track_usage
+from src.ai.processing import get_content_hash, run_cpu_bound, split_document
+from src.services.schema import AIQuestionVariantsResponse, AIRagBatchContextHydrationResponse, AIRagContextHydrationResponse, AIRagResponse, ChunkingStage, CodeLookupAction, CodeLookupActions, CodeSystem, DocumentChunkSimilarityProjectionRead, DocumentRead, DumbStructuredNote, IngestionStrategy, MedicalConcept, MedicalConcepts
 from src.utils import retry
-from src.ai.client import get_embeddings, get_response
-from src.ai.prompts import get_chunk_prompt_input, get_chunk_prompt_instructions, get_question_variants_input, get_question_variants_instructions, get_rag_qa_input, get_rag_qa_instructions, get_structured_note_input, get_structured_note_instructions, get_structured_note_step1_input, get_structured_note_step1_instructions, get_structured_note_step2_input, get_structured_note_step2_instructions, get_structured_note_step4_input, get_structured_note_step4_instructions, get_summarize_prompt_input, get_summarize_prompt_instructions
+from src.ai.client import get_embeddings, get_response, stream_response
+from src.ai.prompts import get_chunk_batch_prompt_input, get_chunk_batch_prompt_instructions, get_chunk_prompt_input, get_chunk_prompt_instructions, get_question_variants_input, get_question_variants_instructions, get_rag_qa_input, get_rag_qa_instructions, get_rag_qa_stream_instructions, get_structured_note_input, get_structured_note_instructions, get_structured_note_step1_input, get_structured_note_step1_instructions, get_structured_note_step2_input, get_structured_note_step2_instructions, get_structured_note_step4_input, get_structured_note_step4_instructions, get_summarize_prompt_input, get_summarize_prompt_instructions
+from src.env import settings
 from src._logging import get_logger
 
 logger = get_logger(__name__)
 
+# [12] or [12, 14]
+CITATION = re.compile(r"\[(\d+(?:\s*,\s*\d+)*)\]")
+
 async def summarize_text(text: str) -> str:
     """
     Summarize the given text using OpenAI API.
     """
     instructions = get_summarize_prompt_instructions()
     input = get_summarize_prompt_input(text)
-    response = await get_response(input=input, instructions = instructions)
+    response = await get_response(input=input, instructions = instructions, cache_sampled = True)
     return response
 
-async def get_question_answer(question: str) -> AIRagResponse:
+async def stream_summary(text: str) -> AsyncIterator[str]:
+    """
+    Streaming summarize_text, yields the summary text as it is generated.
+    """
+    instructions = get_summarize_prompt_instructions()
+    input = get_summarize_prompt_input(text)
+    async for delta in stream_response(input=input, instructions = instructions, cache_sampled = True):
+        yield delta
+
+async def get_relevant_chunks(question: str) -> list[DocumentChunkSimilarityProjectionRead]:
     """
     We generate several versions of the question and perform a cosign sim search. 10 results are kept and used to generate the answer.
     Reranker is not used by design. 
     """
-    logger.debug(f"get_question_answer: {question}")
-
     q_variants_prompt_instructions = get_question_variants_instructions()
     q_variants_prompt_input = get_question_variants_input(question)
     q_variants = await get_response(input = q_variants_prompt_input, instructions=q_variants_prompt_instructions, structured_output = AIQuestionVariantsResponse) 
@@ -42,19 +57,53 @@ async def get_question_answer(question: str) -> AIRagResponse:
     logger.debug(f"----------VARIANTS----------\nQ: {question}\nV: {q_variants.variants}")
     
     q_variant_embeddings = await get_embeddings([question] + q_variants.variants)
-    best_chunks = get_similar_chunks(q_variant_embeddings)
+    best_chunks = await get_similar_chunks(q_variant_embeddings)
     logger.debug(f"----------RETRIEVED CHUNKS----------")
     for it in best_chunks:
         logger.debug(f"---------chunk------------\nsimilarity: {it.similarity * 100 // 1}\ncontext: {it.context}\nchunk:{it.chunk}\n")
 
+    return best_chunks
+
+def resolve_citations(citations: Iterable[str], best_chunks: list[DocumentChunkSimilarityProjectionRead]) -> list[str]:
+    """
+    Attach the cited chunks, ids that were not retrieved are dropped.
+    """
+    best_chunks_map = {str(chunk.id): chunk for chunk in best_chunks}
+    return [f"[{c_id}]: {best_chunks_map[c_id].chunk}" for c_id in citations if c_id in best_chunks_map]
+
+async def get_question_answer(question: str) -> AIRagResponse:
+    """
+    Answer the question from the chunks retrieved by get_relevant_chunks.
+    """
+    logger.debug(f"get_question_answer: {question}")
+
+    best_chunks = await get_relevant_chunks(question)
     answer = await get_response(input = get_rag_qa_input(question, best_chunks), instructions = get_rag_qa_instructions(), structured_output= AIRagResponse)
     
     logger.debug(answer)
     
-    # attach cited chunks
-    best_chunks_map = {str(chunk.id): chunk for chunk in best_chunks}
+    return answer.model_copy(update = {"citations": resolve_citations(answer.citations, best_chunks)})
+
+async def stream_question_answer(question: str) -> AsyncIterator[str | AIRagResponse]:
+    """
+    Streaming get_question_answer. Yields the answer text as it is generated, then the full answer with the resolved citations.
+    The streamed answer is plain text, citations are read back from the [id] markers in it.
+    """
+    logger.debug(f"stream_question_answer: {question}")
+
+    best_chunks = await get_relevant_chunks(question)
 
-    return answer.model_copy(update = {"citations": [f"[{c_id}]: {best_chunks_map[c_id].chunk}" for c_id in answer.citations if c_id in best_chunks_map]})
+    parts: list[str] = []
+    async for delta in stream_response(input = get_rag_qa_input(question, best_chunks), instructions = get_rag_qa_stream_instructions()):
+        parts.append(delta)
+        yield delta
+
+    answer = "".join(parts)
+    cited = dict.fromkeys(c_id for m in CITATION.finditer(answer) for c_id in re.split(r"\s*,\s*", m.group(1)))
+    
+    logger.debug(answer)
+
+    yield AIRagResponse(answer = answer, citations = resolve_citations(cited, best_chunks))
 
 async def get_structured_note_agentic(raw_note: str) -> DumbStructuredNote:
     """
@@ -72,7 +121,7 @@ async def get_structured_note_agentic(raw_note: str) -> DumbStructuredNote:
     logger.debug("Extracting raw concepts")
     extracted_concept_instructions = get_structured_note_step1_instructions()
     extracted_concept_input = get_structured_note_step1_input(raw_note)
-    extracted_concepts = await get_response(input = extracted_concept_input, instructions = extracted_concept_instructions, structured_output=MedicalConcepts)
+    extracted_concepts = await get_response(input = extracted_concept_input, instructions = extracted_concept_instructions, structured_output=MedicalConcepts, cache_sampled = True)
 
     logger.debug(extracted_concepts)
 
@@ -82,7 +131,7 @@ async def get_structured_note_agentic(raw_note: str) -> DumbStructuredNote:
         # get the lookup action. in reality we already know it but for demonstration.
         lookup_action_instructions = get_structured_note_step2_instructions()        
         lookup_action_input = get_structured_note_step2_input(concept)
-        lookup_action = await get_response(input = lookup_action_input, instructions= lookup_action_instructions, structured_output=CodeLookupAction)
+        lookup_action = await get_response(input = lookup_action_input, instructions= lookup_action_instructions, structured_output=CodeLookupAction, cache_sampled = True)
 
         if lookup_action.system is None:
             return concept
@@ -104,7 +153,7 @@ async def get_structured_note_agentic(raw_note: str) -> DumbStructuredNote:
     logger.debug("Finalizing structured note")
     step4_instructions = get_structured_note_step4_instructions()
     step4_input = get_structured_note_step4_input(hydrated_concepts)
-    step4_out = await get_response(input = step4_input, instructions = step4_instructions, structured_output=DumbStructuredNote)
+    step4_out = await get_response(input = step4_input, instructions = step4_instructions, structured_output=DumbStructuredNote, cache_sampled = True)
 
     return step4_out
 
@@ -176,83 +225,249 @@ async def get_fhir(note: DumbStructuredNote) -> Bundle:
         )
     )
 
-async def chunk_document(document: DocumentRead) -> None:
+async def hydrate_chunks(document_id: int, full_doc: str, chunks: list[tuple[int, str]], batch_size: int = settings.HYDRATION_BATCH_SIZE, on_batch: Callable[[dict[int, str]], Awaitable[None]] | None = None) -> dict[int, str]:
     """
-    Master function that kicks off the chunking process. 
+    Derive the missing context of every (index, chunk) given the full document. Returns the contexts keyed by index.
 
-    Returns: a list of contextually aware chunks.
-    """
-    logger.info(f"Chunking started {document.id}...")
+    Chunks are sent `batch_size` at a time in a single structured call. Any chunk the batch call fails to return 
+    (error, missing or unknown index) falls back to its own call. batch_size = 1 is the plain per-chunk mode.
+    The call of the first batch runs alone to warm the prompt cache on the shared document prefix, the rest then run concurrently.
 
-    # title could be relevant, we dont want to throw it out
-    full_doc = document.title + "\n\n" + document.content
+    `on_batch` is awaited with the contexts of each batch as soon as it is done, to checkpoint them.
+    A failed batch does not cancel the others, its error is raised once they all finished.
+    """
 
     # split these up to take advantage of caching. 
     instructions = get_chunk_prompt_instructions(full_doc)
-    chunks = [chunk for chunk in generate_naive_chunks(full_doc, chunk_size=2**10)]
-    
+    batch_instructions = get_chunk_batch_prompt_instructions(full_doc)
+
     @retry
     async def get_context_aware_chunk(id: int, chunk: str) -> AIRagContextHydrationResponse: 
         """
         given a raw chunk, we return the derived context given the full document
         """
-        logger.debug(f"processing chunk #{document.id:04d}-{id:04d}")
+        logger.debug(f"processing chunk #{document_id:04d}-{id:04d}")
         input = get_chunk_prompt_input(chunk)
-        response = await get_response( instructions=instructions, input=input, model=Models.MINI, structured_output=AIRagContextHydrationResponse )
+        response = await get_response( instructions=instructions, input=input, model=Models.MINI, structured_output=AIRagContextHydrationResponse, priority=Priority.BACKGROUND )
         return response
 
-    contexts = await asyncio.gather(
-        *[get_context_aware_chunk(i, input) for i, input in enumerate(chunks)]
-    )
+    async def get_context_aware_chunk_batch(batch: list[tuple[int, str]]) -> dict[int, str]:
+        """
+        given a batch of (index, chunk), we return the derived contexts keyed by index. 
+        """
+        indexes = {i for i, _ in batch}
+        contexts: dict[int, str] = {}
 
-    # combine the contexts and chunks
-    hydrated_chunks = [
-        f"{context.context}\n\n{chunk}" for chunk, context in zip(chunks, contexts)
-    ]
+        if len(batch) > 1:
+            logger.debug(f"processing chunks #{document_id:04d}-{batch[0][0]:04d}..{batch[-1][0]:04d}")
+            try:
+                input = get_chunk_batch_prompt_input(batch)
+                response = await get_response( instructions=batch_instructions, input=input, model=Models.MINI, structured_output=AIRagBatchContextHydrationResponse, priority=Priority.BACKGROUND, timeout=60 )
+                contexts = {it.index: it.context for it in response.contexts if it.index in indexes}
+            except Exception as ex:
+                logger.warning(f"batch hydration failed for document {document_id}, falling back to per chunk calls: {ex}")
+
+        missing = [(i, chunk) for i, chunk in batch if i not in contexts]
+        fallbacks = await asyncio.gather(*[get_context_aware_chunk(i, chunk) for i, chunk in missing])
+        contexts.update({i: it.context for (i, _), it in zip(missing, fallbacks)})
+
+        return contexts
+
+    async def run_batch(batch: list[tuple[int, str]], warm_up: dict[int, str] | Exception | None = None) -> dict[int, str]:
+        """
+        `warm_up` is the outcome of the call for a batch that already ran, only its checkpoint is left.
+        """
+        if isinstance(warm_up, Exception):
+            raise warm_up
+
+        contexts = warm_up if warm_up is not None else await get_context_aware_chunk_batch(batch)
+        if on_batch is not None:
+            await on_batch(contexts)
+        return contexts
+
+    batches = [chunks[i : i + batch_size] for i in range(0, len(chunks), batch_size)]
+
+    # warm then fan out: the first call writes the document prefix into the provider's prompt cache,
+    # the rest are only released once it is there. launching everything at once mostly misses the cache.
+    # only the llm call is waited for, the first checkpoint runs with the other batches and fails like them.
+    runs = []
+    with track_usage() as usage:
+        if batches:
+            try:
+                warm_up = await get_context_aware_chunk_batch(batches[0])
+            except Exception as ex:
+                warm_up = ex
+            warm_up_cached_tokens = usage.cached_tokens
+            runs.append(run_batch(batches[0], warm_up))
+
+        runs += [run_batch(it) for it in batches[1:]]
+        results = await asyncio.gather(*runs, return_exceptions=True)
+
+    if usage.calls:
+        logger.info(
+            f"hydration {document_id}: {usage.calls} calls, {usage.input_tokens} input tokens, "
+            f"{usage.cached_tokens} cached ({usage.cache_hit_ratio:.0%}, {warm_up_cached_tokens} on the warm up call)"
+        )
 
-    logger.debug("generating embeddings")
+    errors = [it for it in results if isinstance(it, BaseException)]
+    if errors:
+        raise errors[0]
 
-    # use the contextualized chunks to generate the embeddings
-    embeddings = await get_embeddings(hydrated_chunks)
+    return {i: context for result in results for i, context in result.items()}
 
-    logger.debug("persisting embeddings")
+def plan_ingestion(n_tokens: int) -> IngestionStrategy:
+    """
+    Pick the ingestion strategy from the document size.
+    - up to two chunks (INGESTION_DIRECT_MAX_TOKENS): hydration adds nothing the chunk does not already have, embed directly.
+    - up to INGESTION_BATCHED_MAX_TOKENS: batched hydration.
+    - anything larger: one call per chunk, keeping the structured output of each call small.
+    """
+    if n_tokens <= settings.INGESTION_DIRECT_MAX_TOKENS:
+        return IngestionStrategy.DIRECT
+
+    if n_tokens <= settings.INGESTION_BATCHED_MAX_TOKENS:
+        return IngestionStrategy.BATCHED
+
+    return IngestionStrategy.PER_CHUNK
+
+async def chunk_document(document: DocumentRead) -> None:
+    """
+    Master function that kicks off the chunking process. 
+
+    Progress is checkpointed per chunk: the chunks are stored up front, then their contexts and embeddings are saved as 
+    each batch completes. Picking the document up again (failed, or reclaimed after a crash) only processes what is missing.
+    After an edit, chunks are matched to the stored ones by content hash and only new or changed chunks are processed.
+    """
+    logger.info(f"Chunking started {document.id}...")
+
+    # title could be relevant, we dont want to throw it out
+    full_doc = document.title + "\n\n" + document.content
+
+    chunking_strategy, chunks, n_tokens = await run_cpu_bound(split_document, full_doc)
+    logger.debug(f"chunking {document.id} with {chunking_strategy}: {len(chunks)} chunks")
+
+    rows = await get_document_chunks(document.id)
+    if [it.content_hash for it in rows] != [get_content_hash(it) for it in chunks]:
+        # first attempt, or the document was edited: unchanged chunks keep their context and embedding
+        rows = await reindex_document_chunks(document.id, document.chunking_claim, chunks)
+
+    ingestion_strategy = plan_ingestion(n_tokens)
+    await save_chunking_plan(document.id, document.chunking_claim, ingestion_strategy, len(chunks))
+
+    ids = [it.id for it in rows]
+    contexts = {i: it.context for i, it in enumerate(rows) if it.context is not None}
+    missing_contexts = [(i, chunks[i]) for i in range(len(chunks)) if i not in contexts]
+    missing_embeddings = {i: contexts[i] for i, it in enumerate(rows) if it.context is not None and not it.embedded}
+    logger.debug(
+        f"ingesting {document.id} with {ingestion_strategy.value}: "
+        f"{len(missing_contexts)} chunks to hydrate, {len(missing_embeddings)} hydrated chunks to embed"
+    )
 
-    # persist
-    with UnitOfWork() as uow:
-        for i, (chunk, context) in enumerate(zip(chunks, contexts)):
-            embedding = embeddings[i]
-            document_chunk = DocumentChunkCreate(
-                document_id=document.id,
-                context = context.context,
-                chunk=chunk,
-                embedding= embedding,
-            )
-            uow.chunks.create(document_chunk)
+    async def embed(batch: dict[int, str]) -> None:
+        """
+        Embed the contextualized chunks of a batch of {index: context} and save the embeddings.
+        """
+        hydrated_chunks = [f"{context}\n\n{chunks[i]}" if context else chunks[i] for i, context in batch.items()]
+        embeddings = await get_embeddings(hydrated_chunks, priority=Priority.BACKGROUND)
+        await save_document_chunks(document.id, document.chunking_claim, [{"id": ids[i], "embedding": embedding} for i, embedding in zip(batch, embeddings)])
+
+    async def checkpoint(batch: dict[int, str]) -> None:
+        """
+        Save the contexts of a batch before embedding it, so a failure further down does not lose the hydration calls.
+        """
+        await save_document_chunks(document.id, document.chunking_claim, [{"id": ids[i], "context": context} for i, context in batch.items()])
+        await embed(batch)
+
+    stages = []
+    if missing_embeddings:
+        stages.append(embed(missing_embeddings))
+
+    if missing_contexts:
+        if ingestion_strategy == IngestionStrategy.DIRECT:
+            stages.append(checkpoint({i: "" for i, _ in missing_contexts}))
+        elif ingestion_strategy == IngestionStrategy.BATCHED:
+            stages.append(hydrate_chunks(document.id, full_doc, missing_contexts, settings.HYDRATION_BATCH_SIZE, on_batch = checkpoint))
+        else:
+            stages.append(hydrate_chunks(document.id, full_doc, missing_contexts, batch_size = 1, on_batch = checkpoint))
+
+    results = await asyncio.gather(*stages, return_exceptions=True)
+    errors = [it for it in results if isinstance(it, BaseException)]
+    if errors:
+        raise errors[0]
 
     logger.info(f"Chunking complete {document.id}")
 
-async def document_chunking_worker():
+async def _renew_lease_forever(document_id: int, claim: int) -> None:
+    """
+    Heartbeat while a document is being chunked, so other workers only reclaim it once this one is gone.
+    Stops once the claim is lost, the run itself finds out at its next checkpoint.
+    """
     while True:
+        await asyncio.sleep(settings.CHUNKING_LEASE_SECONDS / 3)
         try:
+            if not await renew_chunking_lease(document_id, claim):
+                logger.info(f"document {document_id} was requeued while chunking, no longer renewing claim {claim}")
+                return
+        except Exception as ex:
+            logger.warning(f"Failed renewing the lease of document {document_id}: {ex}")
+
+async def process_chunking_document(document: DocumentRead) -> None:
+    """
+    Chunk a claimed document and record the outcome, renewing its lease meanwhile.
+    """
+    heartbeat = asyncio.create_task(_renew_lease_forever(document.id, document.chunking_claim))
+    stage = ChunkingStage.FAILED
+    try:
+        await chunk_document( document )
+        stage = ChunkingStage.COMPLETED
+
+    except ChunkingClaimLostError:
+        logger.info(f"document {document.id} lost claim {document.chunking_claim} while chunking, stopped")
+
+    except Exception:
+        logger.exception(f"Failed chunking document {document.id}")
+
+    finally:
+        heartbeat.cancel()
+
+    if not await finish_chunking(document.id, document.chunking_claim, stage):
+        logger.info(f"document {document.id} was requeued while chunking, not marking it {stage.value}")
+
+async def _chunking_worker(name: str, wake: asyncio.Event) -> None:
+    while True:
+        try:
+            # cleared before looking so a notification arriving while we look is not lost
+            wake.clear()
+
             # the db has the queued up documents, we pull one and lock it 
-            pending_doc = get_next_chunking_document()
+            pending_doc = await get_next_chunking_document()
 
             if pending_doc is not None:
-                try:
-                    await chunk_document( pending_doc )
-                    update_document(DocumentUpdate(id = pending_doc.id, chunking_stage=ChunkingStage.COMPLETED))
-
-                except Exception as ex:
-                    logger.exception(f"Failed chunking document {pending_doc.id}", ex)
-                    update_document(DocumentUpdate(id = pending_doc.id, chunking_stage=ChunkingStage.FAILED))
+                logger.debug(f"{name} claimed document {pending_doc.id}")
+                await process_chunking_document(pending_doc)
 
             else:
-                await asyncio.sleep(2)
+                try:
+                    await asyncio.wait_for(wake.wait(), settings.CHUNKING_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
         
-        except Exception as ex:
-            logger.exception("Document chunking worker error", ex)
+        except Exception:
+            logger.exception(f"Document chunking worker {name} error")
             await asyncio.sleep(2)
 
+async def document_chunking_worker(concurrency: int = settings.CHUNKING_WORKERS):
+    """
+    Pool of `concurrency` chunking tasks. Documents are claimed with FOR UPDATE SKIP LOCKED, so any number of pools 
+    (processes) can share the queue. Idle tasks sleep until create_document sends a NOTIFY, or CHUNKING_POLL_SECONDS pass.
+    """
+    wake = asyncio.Event()
+    listener = asyncio.create_task(listen_for_chunking(wake))
+    try:
+        await asyncio.gather(*[_chunking_worker(f"chunker-{i}", wake) for i in range(concurrency)])
+    finally:
+        listener.cancel()
+
 
 
 if __name__ == "__main__":
@@ -1,72 +1,261 @@
 
 import asyncio
-from src.services.schema import DocumentChunkRead, DocumentChunkSimilarityRead, DocumentCreate, DocumentRead, DocumentUpdate
-from src.db.engine import UnitOfWork
+from psycopg import OperationalError
+import sqlalchemy
 
-def get_documents() -> list[DocumentRead]:
+from src.ai.processing import get_content_hash
+from src.services.schema import ChunkingStage, DocumentChunkSimilarityProjectionRead, DocumentCreate, DocumentRead, DocumentUpdate, IngestionStrategy
+from src.db.engine import AsyncUnitOfWork, get_listen_connection
+from src.db.repositories import CHUNKING_CHANNEL, DuplicateDocumentError
+from src.env import settings
+from src._logging import get_logger
+
+logger = get_logger(__name__)
+
+async def get_documents() -> list[DocumentRead]:
     """
     Get all documents from the database.
     """
         
-    with UnitOfWork() as uow:
-        documents = uow.documents.get_all()
+    async with AsyncUnitOfWork() as uow:
+        documents = await uow.documents.get_all()
 
         return [DocumentRead.model_validate(doc) for doc in documents]
     
     
-def get_document(document_id: int) -> DocumentRead:
+async def get_document(document_id: int) -> DocumentRead:
     """
     Get a document by its ID.
     """
-    with UnitOfWork() as uow:
-        result = uow.documents.get(document_id)
+    async with AsyncUnitOfWork() as uow:
+        result = await uow.documents.get(document_id)
         
         return DocumentRead.model_validate(result)
 
 
-def update_document(document: DocumentUpdate) -> DocumentRead:
+async def update_document(document: DocumentUpdate) -> DocumentRead:
     """
     Update a document in the database.
     """
-    with UnitOfWork() as uow:
-        db_doc = uow.documents.update(document)
+    async with AsyncUnitOfWork() as uow:
+        db_doc = await uow.documents.update(document)
         
         return DocumentRead.model_validate(db_doc)
 
 
-def create_document(document: DocumentCreate) -> DocumentRead:
+async def create_document(document: DocumentCreate) -> DocumentRead:
     """
-    Insert a document into the database.
+    Insert a document into the database. A document with the same content as an existing one is handled per
+    DOCUMENT_DEDUP_POLICY: linked to the existing chunks, rejected with DuplicateDocumentError, or chunked again.
     """
 
-    with UnitOfWork() as uow:
-        db_doc = uow.documents.create(document)
+    async with AsyncUnitOfWork() as uow:
+        canonical = None
+        if settings.DOCUMENT_DEDUP_POLICY != "off":
+            content_hash = get_content_hash(document.content)
+            await uow.documents.lock_content(content_hash)
+            canonical = await uow.documents.get_canonical(content_hash)
+
+        if canonical is not None and settings.DOCUMENT_DEDUP_POLICY == "unique":
+            raise DuplicateDocumentError(canonical.id)
+
+        db_doc = await uow.documents.create(document)
+        if canonical is not None:
+            db_doc = await uow.documents.link(db_doc.id, canonical.id)
+        else:
+            await uow.documents.notify_chunking(db_doc.id)
         
         return DocumentRead.model_validate(db_doc)
     
-def delete_document(document_id: int) -> None:
+async def delete_document(document_id: int) -> None:
+    """
+    Delete a document from the database. If other documents share its chunks, the oldest of them is chunked in its place.
+    """
+
+    async with AsyncUnitOfWork() as uow:
+        promoted_id = await uow.documents.release_duplicates(document_id, move_chunks = True)
+        await uow.documents.delete(document_id)
+
+        if promoted_id is not None:
+            await uow.documents.notify_chunking(promoted_id)
+
+async def backfill_documents() -> dict[str, int]:
     """
-    Delete a document from the database.
+    Hash the documents and chunks created before content hashes existed, then link the documents with the same content to a single
+    chunk set: a completed document is kept as canonical when there is one, else the oldest.
+    A linked document hands its own duplicates over to the canonical, see link.
     """
+    async with AsyncUnitOfWork() as uow:
+        chunks_hashed = await uow.chunks.backfill_content_hashes()
+        hashed = await uow.documents.backfill_content_hashes()
 
-    with UnitOfWork() as uow:
-        uow.documents.delete(document_id)
+        linked = 0
+        groups = await uow.documents.get_duplicate_groups()
+        for group in groups:
+            canonical = next((it for it in group if it.chunking_stage == ChunkingStage.COMPLETED), group[0])
+            for it in group:
+                if it.id != canonical.id:
+                    await uow.documents.link(it.id, canonical.id)
+                    linked += 1
 
-def get_similar_chunks(embeddings: list[list[float]]) -> list[DocumentChunkSimilarityRead]:
-    with UnitOfWork() as uow:
-        r = uow.chunks.get_similarities(embeddings)
-        return [            
-            DocumentChunkSimilarityRead( 
-                **DocumentChunkRead.model_validate(chunk_content, from_attributes=True).model_dump(),                
-                similarity=similarity,
-            )
-            for chunk_content, similarity in r
-        ]
+    return {"chunks_hashed": chunks_hashed, "hashed": hashed, "groups": len(groups), "linked": linked}
 
-def get_next_chunking_document() -> DocumentRead | None:
-    with UnitOfWork() as uow:
-        pending = uow.documents.get_next_chunking()
+async def get_similar_chunks(embeddings: list[list[float]]) -> list[DocumentChunkSimilarityProjectionRead]:
+    """
+    Get the closest chunks to the given embeddings. Only the columns needed for prompting are loaded.
+    """
+    async with AsyncUnitOfWork() as uow:
+        r = await uow.chunks.get_similarity_projections(embeddings)
+        return [DocumentChunkSimilarityProjectionRead.model_validate(row) for row in r]
+
+async def get_next_chunking_document() -> DocumentRead | None:
+    async with AsyncUnitOfWork() as uow:
+        pending = await uow.documents.get_next_chunking()
         if pending:
             return DocumentRead.model_validate(pending)
         else:
-            return None
\ No newline at end of file
+            return None
+
+async def edit_document(document: DocumentUpdate) -> DocumentRead:
+    """
+    Update the title and/or content of a document. Any change queues it for re-indexing: 
+    only the chunks that changed go through hydration and embedding again.
+    A document whose content changes no longer shares chunks: it stops being a duplicate, and its own duplicates promote one of theirs.
+    """
+    async with AsyncUnitOfWork() as uow:
+        db_doc = await uow.documents.get(document.id)
+
+        promoted_id = None
+        if document.content is not None and get_content_hash(document.content) != db_doc.content_hash:
+            promoted_id = await uow.documents.release_duplicates(document.id, move_chunks = False)
+            db_doc.canonical_id = None
+
+        db_doc = await uow.documents.update(document)
+
+        # a duplicate keeps pointing at the canonical chunks when only its title changes
+        if (document.title is not None or document.content is not None) and db_doc.canonical_id is None:
+            db_doc = await uow.documents.requeue(document.id)
+            await uow.documents.notify_chunking(document.id)
+        if promoted_id is not None:
+            await uow.documents.notify_chunking(promoted_id)
+
+        return DocumentRead.model_validate(db_doc)
+
+async def finish_chunking(document_id: int, claim: int, stage: ChunkingStage) -> bool:
+    """
+    Record the outcome of chunking, see AsyncDocumentRepository.finish_chunking.
+    When the document was requeued meanwhile, the run that was chunking it is now done: the next one can start right away.
+    """
+    async with AsyncUnitOfWork() as uow:
+        if await uow.documents.finish_chunking(document_id, claim, stage):
+            return True
+
+        if await uow.documents.release_lease(document_id):
+            await uow.documents.notify_chunking(document_id)
+        return False
+
+async def requeue_document(document_id: int) -> DocumentRead:
+    """
+    Queue a document for chunking again, e.g. once it ran out of attempts. Only the chunks not done yet are processed.
+    Duplicates have nothing to chunk of their own, the document whose chunks they share is queued instead.
+    """
+    async with AsyncUnitOfWork() as uow:
+        db_doc = await uow.documents.get(document_id)
+        chunked_id = db_doc.canonical_id or document_id
+
+        await uow.documents.requeue(chunked_id)
+        await uow.documents.notify_chunking(chunked_id)
+
+        return DocumentRead.model_validate(await uow.documents.get(document_id))
+
+async def get_document_chunks(document_id: int) -> list[sqlalchemy.Row]:
+    """
+    The chunking progress of a document, see AsyncDocumentChunkRepository.get_progress.
+    """
+    async with AsyncUnitOfWork() as uow:
+        return await uow.chunks.get_progress(document_id)
+
+async def save_chunking_plan(document_id: int, claim: int, ingestion_strategy: IngestionStrategy, chunks_total: int) -> None:
+    """
+    Record how the run holding `claim` ingests the document.
+    """
+    async with AsyncUnitOfWork() as uow:
+        await uow.documents.hold_claim(document_id, claim)
+        await uow.documents.update(DocumentUpdate(id = document_id, ingestion_strategy = ingestion_strategy, chunks_total = chunks_total))
+
+async def reindex_document_chunks(document_id: int, claim: int, chunks: list[str]) -> list[sqlalchemy.Row]:
+    """
+    Line the stored chunks of a document up with `chunks` by content hash. 
+    Unchanged chunks keep their context and embedding (moved to their new position), new ones are added pending 
+    and the ones no longer in the document are deleted. Returns the progress rows in the new order.
+    Raises ChunkingClaimLostError unless `claim` still holds the document.
+    """
+    async with AsyncUnitOfWork() as uow:
+        await uow.documents.hold_claim(document_id, claim)
+        rows = await uow.chunks.get_progress(document_id)
+
+        reusable: dict[str, list[sqlalchemy.Row]] = {}
+        for it in rows:
+            reusable.setdefault(it.content_hash, []).append(it)
+
+        moved: list[dict] = []
+        created: dict[int, str] = {}
+        n_reused = 0
+        for i, chunk in enumerate(chunks):
+            matches = reusable.get(get_content_hash(chunk))
+            if matches:
+                row = matches.pop(0)
+                n_reused += 1
+                if row.position != i:
+                    moved.append({"id": row.id, "position": i})
+            else:
+                created[i] = chunk
+
+        stale = [it.id for matches in reusable.values() for it in matches]
+
+        await uow.chunks.delete_many(stale)
+        await uow.chunks.update_many(moved)
+        await uow.chunks.create_pending(document_id, created)
+        await uow.documents.refresh_progress(document_id)
+
+        if rows:
+            logger.info(f"re-indexing {document_id}: {n_reused} chunks reused, {len(created)} new, {len(stale)} dropped")
+
+        return await uow.chunks.get_progress(document_id)
+
+async def save_document_chunks(document_id: int, claim: int, values: list[dict]) -> None:
+    """
+    Checkpoint chunk results (context and/or embedding by chunk id) and update the document progress.
+    Raises ChunkingClaimLostError unless `claim` still holds the document.
+    """
+    async with AsyncUnitOfWork() as uow:
+        await uow.documents.add_progress(document_id, claim, sum(1 for it in values if it.get("embedding") is not None))
+        await uow.chunks.save_results(values)
+
+async def renew_chunking_lease(document_id: int, claim: int) -> bool:
+    async with AsyncUnitOfWork() as uow:
+        return await uow.documents.renew_lease(document_id, claim)
+
+async def listen_for_chunking(wake: asyncio.Event, reconnect_delay: float = 5) -> None:
+    """
+    Set `wake` whenever a document is queued for chunking (see create_document). Runs until cancelled, reconnecting on errors.
+    """
+    while True:
+        try:
+            conn = await get_listen_connection()
+            async with conn:
+                await conn.execute(f"LISTEN {CHUNKING_CHANNEL}")
+                # anything queued while we were not listening
+                wake.set()
+
+                async for _ in conn.notifies():
+                    wake.set()
+
+        except OperationalError as ex:
+            logger.warning(f"chunking listener disconnected: {ex}")
+            await asyncio.sleep(reconnect_delay)
+
+        except Exception:
+            # anything else would end the task silently, the worker would then only wake up on its poll interval
+            logger.exception("chunking listener failed, reconnecting")
+            await asyncio.sleep(reconnect_delay)
@@ -1,5 +1,6 @@
 from enum import Enum
 from typing import Literal, Optional
+import numpy as np
 from pydantic import BaseModel, Field
 
 class ChunkingStage(str, Enum):
@@ -8,6 +9,15 @@ class ChunkingStage(str, Enum):
     COMPLETED = "completed"
     FAILED = "failed"
 
+class IngestionStrategy(str, Enum):
+    DIRECT = "direct"           # small documents, chunks are embedded as is without hydration
+    BATCHED = "batched"         # several chunks hydrated per llm call
+    PER_CHUNK = "per_chunk"     # one hydration call per chunk
+
+class SimilaritySearchMode(str, Enum):
+    EXACT = "exact"         # cross join every query against every chunk. always exact, always a seq scan.
+    INDEXED = "indexed"     # one hnsw backed top-k per query, merged by min distance. approximate.
+
 class OrmBaseModel(BaseModel):
     model_config = {
         "from_attributes": True,
@@ -17,6 +27,7 @@ class DocumentBase(OrmBaseModel):
     title: str = Field(..., description="Title of the document")
     content: str = Field(..., description="Content of the document")
     chunking_stage: ChunkingStage = Field(ChunkingStage.NOT_STARTED, description="The current chunking stage of the document.")
+    ingestion_strategy: Optional[IngestionStrategy] = Field(None, description="The ingestion strategy picked for the document once chunking starts.")
 
 class DocumentCreate(DocumentBase):
     pass
@@ -26,9 +37,16 @@ class DocumentUpdate(DocumentBase):
     title: Optional[str] = Field(None, description="Title of the document")
     content: Optional[str] = Field(None, description="Content of the document")
     chunking_stage: Optional[ChunkingStage] = Field(None, description="The current chunking stage of the document.")
+    ingestion_strategy: Optional[IngestionStrategy] = Field(None, description="The ingestion strategy picked for the document once chunking starts.")
+    chunks_total: Optional[int] = Field(None, description="Number of chunks the document was split into.")
     
 class DocumentRead(DocumentBase):
     id: int = Field(..., description="ID of the document")
+    chunks_total: Optional[int] = Field(None, description="Number of chunks the document was split into, once chunking started.")
+    chunks_done: int = Field(0, description="Number of chunks hydrated and embedded so far.")
+    chunking_claim: int = Field(0, description="Bumped every time a worker claims the document or it is requeued.")
+    content_hash: Optional[str] = Field(None, description="sha256 of the content.")
+    canonical_id: Optional[int] = Field(None, description="Set when the content duplicates another document: ID of the document whose chunks this one shares.")
 
 class DocumentChunkBase(OrmBaseModel):    
     document_id: int = Field(..., description="ID of the parent document.")
@@ -37,7 +55,12 @@ class DocumentChunkBase(OrmBaseModel):
     embedding: list[float] = Field(..., description="Embedding of the chunk.")
 
 class DocumentChunkCreate(DocumentChunkBase):
-    pass
+    model_config = {
+        "from_attributes": True,
+        "arbitrary_types_allowed": True,
+    }
+
+    embedding: np.ndarray | list[float] = Field(..., description="Embedding of the chunk. float32 arrays are passed through as is.")
 
 class DocumentChunkUpdate(DocumentChunkBase):
     id: int = Field(..., description="ID of the chunk")
@@ -52,12 +75,28 @@ class DocumentChunkRead(DocumentChunkBase):
 class DocumentChunkSimilarityRead(DocumentChunkRead):
     similarity: float = Field(..., description="The computed similarity of the chunk.")
 
+class DocumentChunkProjectionRead(OrmBaseModel):
+    id: int = Field(..., description="ID of the chunk")
+    document_id: int = Field(..., description="ID of the parent document.")
+    context: str = Field(..., description="The surrounding context to this chunk used to generate an embedding.")
+    chunk: str = Field(..., description="The text of the chunk.")
+
+class DocumentChunkSimilarityProjectionRead(DocumentChunkProjectionRead):
+    similarity: float = Field(..., description="The computed similarity (cosine distance) of the chunk.")
+
 class AIQuestionVariantsResponse(BaseModel):
     variants: list[str] = Field(..., description="The list of question variants.")
 
 class AIRagContextHydrationResponse(BaseModel):
     context: str = Field(..., description = "The missing context for the given chunk. Empty string if chunk is self contained.")
 
+class AIRagChunkContext(BaseModel):
+    index: int = Field(..., description = "The index of the chunk this context belongs to.")
+    context: str = Field(..., description = "The missing context for the given chunk. Empty string if chunk is self contained.")
+
+class AIRagBatchContextHydrationResponse(BaseModel):
+    contexts: list[AIRagChunkContext] = Field(default_factory=list, description = "One context per chunk, keyed by chunk index.")
+
 class AIRagResponse(BaseModel):
     answer: str = Field(..., description= "The answer to the question.")
     citations: list[str] = Field(..., description="A list of all of the cited chunks in the answer. Every item in this list should exist as a citation in the answer.")
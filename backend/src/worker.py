@@ -0,0 +1,40 @@
+"""
+Standalone chunking worker, scaled independently of the api.
+
+    python -m src.worker [--concurrency N]
+
+Run the api with RUN_CHUNKING_WORKER=false so it does not chunk in its own event loop as well.
+Any number of these processes can run side by side, documents are claimed with FOR UPDATE SKIP LOCKED.
+"""
+import argparse
+import asyncio
+import signal
+
+from src.db.engine import init_db
+from src.env import settings
+from src.services import ai as ai_service
+from src._logging import get_logger
+
+logger = get_logger(__name__)
+
+async def main(concurrency: int) -> None:
+    worker = asyncio.create_task(ai_service.document_chunking_worker(concurrency))
+
+    # let the running chunks stop cleanly on docker stop / ctrl-c. unfinished documents are reclaimed once their lease runs out.
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.cancel)
+
+    logger.info(f"Chunking worker started with {concurrency} tasks")
+    try:
+        await worker
+    except asyncio.CancelledError:
+        logger.info("Chunking worker stopped")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Chunk the documents queued in the db.")
+    parser.add_argument("--concurrency", type = int, default = settings.CHUNKING_WORKERS, help = "Documents chunked concurrently. Defaults to CHUNKING_WORKERS.")
+    args = parser.parse_args()
+
+    init_db()
+    asyncio.run(main(args.concurrency))
@@ -0,0 +1,49 @@
+import asyncio
+from contextlib import asynccontextmanager
+import os
+from typing import AsyncIterator
+
+# settings are read when src is first imported
+os.environ.setdefault("OPENAI_API_KEY", "test")
+if "TEST_DATABASE_URL" in os.environ:
+    os.environ["DATABASE_URL"] = os.environ["TEST_DATABASE_URL"]
+
+import pytest
+import uvicorn
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+@pytest.fixture(scope="session")
+def db():
+    """
+    A scratch postgres db with pgvector, opt in with TEST_DATABASE_URL. Tests roll back what they write.
+    """
+    if "TEST_DATABASE_URL" not in os.environ:
+        pytest.skip("set TEST_DATABASE_URL to a scratch postgres db with pgvector")
+
+    from src.db.engine import init_db
+    init_db()
+
+@asynccontextmanager
+async def _serve(app) -> AsyncIterator[str]:
+    server = uvicorn.Server(uvicorn.Config(app, port = 0, log_level = "warning"))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(.01)
+
+    port = server.servers[0].sockets[0].getsockname()[1]
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        await serving
+
+@pytest.fixture
+def serve():
+    """
+    `async with serve(app) as base_url` runs an asgi app on an ephemeral port.
+    A real server, the TestClient and the asgi transport of httpx buffer streamed responses.
+    """
+    return _serve
@@ -0,0 +1,118 @@
+"""
+The server-sent event endpoints, with the llm stream and the retrieval stubbed.
+"""
+import asyncio
+import importlib
+import json
+import time
+
+from fastapi import FastAPI
+import httpx
+import pytest
+
+from src.ai.client import OpenAIError
+from src.db import engine
+from src.env import settings
+from src.services import ai
+from src.services.schema import DocumentChunkSimilarityProjectionRead
+
+pytestmark = pytest.mark.anyio
+
+TOKEN_DELAY = .02
+ANSWER = "Metformin was started [1]. The dose was raised twice [1, 2], then paused [9]."
+# one word per delta, like the model streams
+TOKENS = [it + " " for it in ANSWER.split(" ")[:-1]] + [ANSWER.split(" ")[-1]]
+
+CHUNKS = [
+    DocumentChunkSimilarityProjectionRead(id = 1, document_id = 1, context = "", chunk = "started metformin 500mg", similarity = .1),
+    DocumentChunkSimilarityProjectionRead(id = 2, document_id = 1, context = "", chunk = "metformin raised to 1000mg", similarity = .2),
+]
+
+@pytest.fixture
+def app(monkeypatch) -> FastAPI:
+    """
+    The api without its db: init_db runs when the module is imported, the chunking worker with the lifespan.
+    """
+    monkeypatch.setattr(engine, "init_db", lambda: None)
+    monkeypatch.setattr(settings, "RUN_CHUNKING_WORKER", False)
+    return importlib.import_module("src.api.app").app
+
+@pytest.fixture
+def stream_calls(monkeypatch) -> list[dict]:
+    """
+    Stub the llm stream, one token every TOKEN_DELAY seconds, and the retrieval of the question answering.
+    """
+    calls = []
+
+    async def stream_response(**kwargs):
+        calls.append(kwargs)
+        for token in TOKENS:
+            await asyncio.sleep(TOKEN_DELAY)
+            yield token
+
+    async def get_relevant_chunks(question: str) -> list[DocumentChunkSimilarityProjectionRead]:
+        return CHUNKS
+
+    monkeypatch.setattr(ai, "stream_response", stream_response)
+    monkeypatch.setattr(ai, "get_relevant_chunks", get_relevant_chunks)
+    return calls
+
+async def post_events(app: FastAPI, serve, path: str, body: dict) -> tuple[list[tuple[str, dict]], float, float]:
+    """
+    POST and read the event stream. Returns the (event, data) pairs, the time to the first event and the total time.
+    """
+    async with serve(app) as base_url, httpx.AsyncClient(base_url = base_url) as client:
+        start = time.perf_counter()
+        first_event = None
+        raw = ""
+
+        async with client.stream("POST", path, json = body) as response:
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("text/event-stream")
+
+            async for text in response.aiter_text():
+                first_event = first_event or time.perf_counter() - start
+                raw += text
+
+        total = time.perf_counter() - start
+
+    assert raw.endswith("\n\n")
+    events = []
+    for block in raw.split("\n\n")[:-1]:
+        event, data = block.split("\n")
+        assert event.startswith("event: ") and data.startswith("data: ")
+        events.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+
+    return events, first_event, total
+
+async def test_answer_question_stream(app, serve, stream_calls):
+    events, first_event, total = await post_events(app, serve, "/answer_question/stream", {"question": "metformin?"})
+
+    assert [name for name, _ in events] == ["delta"] * len(TOKENS) + ["citations"]
+    assert "".join(data["text"] for _, data in events[:-1]) == ANSWER
+    # the first delta goes out as soon as the model produced it, not once the answer is complete
+    assert first_event < total / 4
+
+    # [1] and [1, 2] resolve to the retrieved chunks, [9] was not retrieved and is dropped
+    assert events[-1][1] == {
+        "answer": ANSWER,
+        "citations": ["[1]: started metformin 500mg", "[2]: metformin raised to 1000mg"],
+    }
+
+async def test_summarize_note_stream(app, serve, stream_calls):
+    events, first_event, total = await post_events(app, serve, "/summarize_note/stream", {"content": "a long note"})
+
+    assert [name for name, _ in events] == ["delta"] * len(TOKENS) + ["done"]
+    assert events[-1][1] == {"summary": ANSWER}
+    assert first_event < total / 4
+    assert "a long note" in stream_calls[0]["input"]
+
+async def test_error_after_the_stream_started(app, serve, monkeypatch):
+    async def stream_summary(text: str):
+        yield "partial "
+        raise OpenAIError("server_error", "stream broke")
+
+    monkeypatch.setattr(ai, "stream_summary", stream_summary)
+    events, _, _ = await post_events(app, serve, "/summarize_note/stream", {"content": "a long note"})
+
+    assert events == [("delta", {"text": "partial "}), ("error", {"detail": "OpenAI API error"})]
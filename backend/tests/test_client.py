@@ -0,0 +1,180 @@
+"""
+src.ai.client, no OpenAI key or network needed. Responses api calls go to a local fake, embedding calls to a stub.
+"""
+import asyncio
+import json
+import time
+from typing import AsyncIterator
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import numpy as np
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, RateLimitError
+import pytest
+
+from src.ai import client
+from src.ai.client import EmbeddingCoalescer, get_response, stream_response
+from src.ai.models import Models
+from src.ai.rate_limiter import Priority, SlidingWindowRateLimiter, limiters, request_access
+from src.env import settings
+
+pytestmark = pytest.mark.anyio
+
+N_TOKENS = 100
+TOKEN_DELAY = .02           # the fake produces one token every TOKEN_DELAY seconds
+TOKENS = [f"token{i} " for i in range(N_TOKENS)]
+
+LIMIT_TOKENS = 40_000
+LIMIT_REQUESTS = 100
+USED_ELSEWHERE = 15_000     # tokens the fake server reports as spent by someone else
+RETRY_AFTER_MS = 500
+
+def fake_response(text: str) -> dict:
+    return {
+        "id": "resp_fake", "object": "response", "created_at": 0, "model": Models.FULL.value, "status": "completed", "error": None,
+        "output": [{
+            "type": "message", "id": "msg_fake", "role": "assistant", "status": "completed",
+            "content": [{"type": "output_text", "text": text, "annotations": []}],
+        }],
+        "usage": {
+            "input_tokens": 10, "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens": N_TOKENS, "output_tokens_details": {"reasoning_tokens": 0},
+            "total_tokens": 10 + N_TOKENS,
+        },
+    }
+
+streaming_api = FastAPI()
+
+@streaming_api.post("/v1/responses")
+async def streaming_responses(request: Request):
+    body = await request.json()
+
+    if not body.get("stream"):
+        await asyncio.sleep(N_TOKENS * TOKEN_DELAY)
+        return fake_response("".join(TOKENS))
+
+    async def events():
+        for i, token in enumerate(TOKENS):
+            await asyncio.sleep(TOKEN_DELAY)
+            data = {"type": "response.output_text.delta", "sequence_number": i, "item_id": "msg_fake", "output_index": 0, "content_index": 0, "delta": token}
+            yield f"event: response.output_text.delta\ndata: {json.dumps(data)}\n\n"
+
+        data = {"type": "response.completed", "sequence_number": N_TOKENS, "response": fake_response("".join(TOKENS))}
+        yield f"event: response.completed\ndata: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+rate_limited_api = FastAPI()
+
+@rate_limited_api.post("/v1/responses")
+async def rate_limited_responses(request: Request):
+    body = await request.json()
+
+    if body.get("input") == "rate limited":
+        error = {"error": {"message": "Rate limit reached", "type": "tokens", "code": "rate_limit_exceeded", "param": None}}
+        return JSONResponse(error, status_code = 429, headers = {"retry-after-ms": str(RETRY_AFTER_MS)})
+
+    headers = {
+        "x-ratelimit-limit-tokens": str(LIMIT_TOKENS),
+        "x-ratelimit-remaining-tokens": str(LIMIT_TOKENS - USED_ELSEWHERE),
+        "x-ratelimit-limit-requests": str(LIMIT_REQUESTS),
+        "x-ratelimit-remaining-requests": str(LIMIT_REQUESTS - 1),
+        "x-ratelimit-reset-tokens": "6m0s",
+    }
+    return JSONResponse(fake_response("ok"), headers = headers)
+
+@pytest.fixture
+def limiter(monkeypatch) -> SlidingWindowRateLimiter:
+    """
+    A fresh in process bucket for the FULL model, whatever RATE_LIMITER_BACKEND is set to.
+    """
+    limiter = SlidingWindowRateLimiter(settings.OPENAI_MAX_TOKENS_MIN, settings.OPENAI_MAX_REQ_MIN)
+    monkeypatch.setitem(limiters, Models.FULL, limiter)
+    return limiter
+
+@pytest.fixture
+async def openai_client(request, monkeypatch, serve, limiter) -> AsyncIterator[AsyncOpenAI]:
+    """
+    Serve the fake api given by indirect parametrization and point the client module at it.
+    """
+    async with serve(request.param) as base_url:
+        fake_client = AsyncOpenAI(api_key = "fake", base_url = f"{base_url}/v1", http_client = DefaultAsyncHttpxClient(event_hooks = {"response": [client._on_response]}))
+        monkeypatch.setattr(client, "async_client", fake_client)
+        yield fake_client
+
+@pytest.mark.parametrize("openai_client", [streaming_api], indirect = True)
+async def test_stream_response_first_delta_arrives_before_the_blocking_response(openai_client):
+    for i in range(3):
+        start = time.perf_counter()
+        text = await get_response(input = f"blocking {i}", cache = False)
+        blocking = time.perf_counter() - start
+
+        start = time.perf_counter()
+        first_byte = None
+        parts = []
+        async for delta in stream_response(input = f"streaming {i}", cache = False):
+            first_byte = first_byte or time.perf_counter() - start
+            parts.append(delta)
+
+        assert "".join(parts) == text
+        # the blocking call waits for all N_TOKENS, the stream only for the first one
+        assert first_byte < blocking / 4
+
+@pytest.mark.parametrize("openai_client", [rate_limited_api], indirect = True)
+async def test_rate_limiter_adopts_the_header_limits_and_pauses_on_429(openai_client, limiter):
+    await get_response(input = "ok", cache = False)
+    assert (limiter.max_tokens, limiter.max_requests) == (LIMIT_TOKENS, LIMIT_REQUESTS)
+    # the server saw more usage than our own call, the difference is held in the window
+    assert limiter.tokens_in_window > 10 + N_TOKENS
+
+    with pytest.raises(RateLimitError):
+        await openai_client.with_options(max_retries = 0).responses.create(model = Models.FULL.value, input = "rate limited")
+
+    start = time.perf_counter()
+    await request_access(10, Models.FULL)
+    paused = time.perf_counter() - start
+
+    assert limiter.scale < 1
+    assert paused >= RETRY_AFTER_MS / 1000 * .9
+
+@pytest.fixture
+def embed_calls(monkeypatch) -> list[list[str]]:
+    """
+    Stub _embed, one vector per text holding its length. A batch holding "bad" fails as a whole, like an input the api rejects.
+    """
+    calls = []
+
+    async def embed(batch_text: list[str], priority: Priority) -> list[np.ndarray]:
+        calls.append(batch_text)
+        if "bad" in batch_text:
+            raise ValueError("invalid input")
+        return [np.full(3, len(it), dtype=np.float32) for it in batch_text]
+
+    monkeypatch.setattr(client, "_embed", embed)
+    return calls
+
+async def test_coalescer_merges_concurrent_callers(embed_calls):
+    coalescer = EmbeddingCoalescer(.01)
+
+    first, second = await asyncio.gather(
+        coalescer.embed(["a", "bb"], Priority.INTERACTIVE),
+        coalescer.embed(["bb", "ccc"], Priority.INTERACTIVE),
+    )
+
+    assert embed_calls == [["a", "bb", "ccc"]]
+    assert [it[0] for it in first] == [1, 2]
+    assert [it[0] for it in second] == [2, 3]
+
+async def test_coalescer_fails_only_the_faulty_caller(embed_calls):
+    coalescer = EmbeddingCoalescer(.01)
+
+    good, bad = await asyncio.gather(
+        coalescer.embed(["a", "bb"], Priority.INTERACTIVE),
+        coalescer.embed(["bad"], Priority.INTERACTIVE),
+        return_exceptions = True,
+    )
+
+    assert [it[0] for it in good] == [1, 2]
+    assert isinstance(bad, ValueError)
+    # the merged call, then one per caller
+    assert embed_calls == [["a", "bb", "bad"], ["a", "bb"], ["bad"]]
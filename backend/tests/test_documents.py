@@ -0,0 +1,90 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+import uuid
+
+import pytest
+
+from src.db.engine import AsyncUnitOfWork
+from src.services import documents
+from src.services.documents import listen_for_chunking
+from src.services.schema import ChunkingStage, DocumentCreate
+
+pytestmark = pytest.mark.anyio
+
+class FakeListenConnection:
+    """
+    Delivers one notification, then waits like an idle connection.
+    """
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    async def execute(self, query: str):
+        pass
+
+    async def notifies(self):
+        yield "queued"
+        await asyncio.Event().wait()
+
+async def test_listener_reconnects_after_any_error(monkeypatch):
+    attempts = []
+
+    async def get_listen_connection():
+        attempts.append(len(attempts))
+        if len(attempts) == 1:
+            raise RuntimeError("not an OperationalError")
+        return FakeListenConnection()
+
+    monkeypatch.setattr(documents, "get_listen_connection", get_listen_connection)
+
+    wake = asyncio.Event()
+    listener = asyncio.create_task(listen_for_chunking(wake, reconnect_delay = 0))
+    try:
+        await asyncio.wait_for(wake.wait(), 1)
+        assert not listener.done()
+    finally:
+        listener.cancel()
+
+    assert len(attempts) == 2
+
+@pytest.fixture
+async def uow(db):
+    """
+    An async unit of work rolled back after the test.
+    """
+    async with AsyncUnitOfWork() as uow:
+        yield uow
+        await uow.session.rollback()
+
+async def test_link_fences_the_run_in_progress(uow):
+    content = f"duplicate {uuid.uuid4()}"
+    canonical = await uow.documents.create(DocumentCreate(title = "canonical", content = content))
+    member = await uow.documents.create(DocumentCreate(title = "member", content = content))
+
+    # a worker is chunking the member when the backfill links it
+    member.chunking_stage = ChunkingStage.IN_PROGRESS
+    member.lease_expires_at = datetime.now(timezone.utc) + timedelta(minutes = 5)
+    claim = member.chunking_claim
+    await uow.documents.link(member.id, canonical.id)
+
+    assert member.canonical_id == canonical.id
+    assert member.chunking_stage == canonical.chunking_stage
+    assert member.lease_expires_at is None
+    assert member.chunking_claim == claim + 1
+    assert not await uow.documents.renew_lease(member.id, claim)
+
+async def test_link_hands_over_the_duplicates_of_the_document(uow):
+    content = f"duplicate {uuid.uuid4()}"
+    canonical = await uow.documents.create(DocumentCreate(title = "canonical", content = content))
+    member = await uow.documents.create(DocumentCreate(title = "member", content = content))
+    duplicate = await uow.documents.create(DocumentCreate(title = "duplicate", content = content))
+    await uow.documents.link(duplicate.id, member.id)
+
+    # the backfill links a canonical document that already has duplicates
+    await uow.documents.link(member.id, canonical.id)
+    await uow.session.refresh(duplicate)
+
+    assert (member.canonical_id, duplicate.canonical_id) == (canonical.id, canonical.id)
+    assert duplicate.chunking_stage == canonical.chunking_stage
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from src.services import ai
+from src.services.ai import hydrate_chunks
+from src.services.schema import AIRagBatchContextHydrationResponse, AIRagChunkContext
+
+pytestmark = pytest.mark.anyio
+
+CHUNKS = [(i, f"chunk {i}") for i in range(6)]
+
+@pytest.fixture
+def calls(monkeypatch) -> list[list[int]]:
+    """
+    Stub the batch call, it answers every index. Records the indexes of each call in order.
+    """
+    calls = []
+
+    async def get_response(*, input: str, **kwargs):
+        indexes = [i for i, chunk in CHUNKS if chunk in input]
+        calls.append(indexes)
+        await asyncio.sleep(.01)
+        return AIRagBatchContextHydrationResponse(contexts = [AIRagChunkContext(index = i, context = f"context {i}") for i in indexes])
+
+    monkeypatch.setattr(ai, "get_response", get_response)
+    return calls
+
+async def test_only_the_warm_up_call_runs_alone(calls):
+    async def on_batch(contexts: dict[int, str]):
+        if 0 in contexts:
+            # the other calls are released without waiting for the first checkpoint
+            while len(calls) < 3:
+                await asyncio.sleep(.001)
+
+    contexts = await asyncio.wait_for(hydrate_chunks(1, "document", CHUNKS, batch_size = 2, on_batch = on_batch), 1)
+
+    assert calls[0] == [0, 1]
+    assert contexts == {i: f"context {i}" for i, _ in CHUNKS}
+
+async def test_a_failed_first_checkpoint_does_not_cancel_the_others(calls):
+    saved = []
+
+    async def on_batch(contexts: dict[int, str]):
+        if 0 in contexts:
+            raise RuntimeError("checkpoint failed")
+        await asyncio.sleep(.01)
+        saved.extend(contexts)
+
+    with pytest.raises(RuntimeError, match = "checkpoint failed"):
+        await hydrate_chunks(1, "document", CHUNKS, batch_size = 2, on_batch = on_batch)
+
+    assert sorted(saved) == [2, 3, 4, 5]
@@ -0,0 +1,66 @@
+from pathlib import Path
+
+import pytest
+
+from src.ai.processing import CHUNK_OVERLAP_TOKENS, CHUNK_TOKENS, detect_chunking_strategy, generate_token_chunks, get_chunker, get_encoding, split_document
+
+RESOURCES = Path(__file__).parents[1] / "resources"
+
+def n_tokens(text: str) -> int:
+    return len(get_encoding().encode_ordinary(text))
+
+def overlap_text(chunk: str, overlap: int) -> str:
+    """
+    The last `overlap` tokens of a chunk, where the next window starts.
+    """
+    encoding = get_encoding()
+    return encoding.decode(encoding.encode_ordinary(chunk)[-overlap:])
+
+@pytest.fixture
+def text() -> str:
+    return " ".join(f"word{i}" for i in range(2000))
+
+@pytest.mark.parametrize("chunk_tokens, overlap", [(CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS), (40, 10), (7, 1)])
+def test_token_chunks_are_bounded_and_overlap(text, chunk_tokens, overlap):
+    chunks = list(generate_token_chunks(text, chunk_tokens, overlap))
+
+    assert len(chunks) > 1
+    assert all(n_tokens(it) == chunk_tokens for it in chunks[:-1])
+    assert 0 < n_tokens(chunks[-1]) <= chunk_tokens
+
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk.startswith(overlap_text(previous, overlap))
+
+def test_token_chunks_cover_the_text(text):
+    chunks = list(generate_token_chunks(text, 40, 10))
+
+    rebuilt = chunks[0] + "".join(chunk[len(overlap_text(previous, 10)):] for previous, chunk in zip(chunks, chunks[1:]))
+    assert rebuilt == text
+
+def test_token_chunks_of_a_short_text():
+    assert list(generate_token_chunks("just a few tokens")) == ["just a few tokens"]
+    assert list(generate_token_chunks("")) == []
+
+def test_token_chunks_reject_an_overlap_as_large_as_the_window(text):
+    with pytest.raises(ValueError):
+        next(generate_token_chunks(text, 10, 10))
+
+@pytest.mark.parametrize("path", sorted(RESOURCES.glob("*.txt")), ids = lambda it: it.name)
+def test_split_document_keeps_chunks_within_budget(path):
+    text = path.read_text()
+    strategy, chunks, count = split_document(text)
+
+    assert strategy in ("token", "section", "speaker")
+    assert chunks
+    assert all(n_tokens(it) <= CHUNK_TOKENS for it in chunks)
+    assert count == n_tokens(text)
+
+@pytest.mark.parametrize("path", sorted(RESOURCES.glob("*.txt")), ids = lambda it: it.name)
+def test_crlf_documents_chunk_like_lf_documents(path):
+    text = path.read_text()
+    crlf = text.replace("\n", "\r\n")
+    strategy = detect_chunking_strategy(text)
+
+    assert detect_chunking_strategy(crlf) == strategy
+    if strategy != "token":
+        assert list(get_chunker(strategy)(crlf)) == list(get_chunker(strategy)(text))
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from sqlalchemy import text
+
+from src.ai.models import EMBED_DIM
+from src.db.engine import UnitOfWork
+from src.services.schema import DocumentCreate, SimilaritySearchMode
+
+N_CHUNKS = 500
+
+@pytest.fixture
+def uow(db):
+    """
+    A unit of work over N_CHUNKS chunks with random embeddings, analyzed. Rolled back after the test.
+    """
+    with UnitOfWork() as uow:
+        document = uow.documents.create(DocumentCreate(title = "similarity", content = "similarity"))
+        conn = uow.session.connection()
+        conn.execute(
+            text("""
+                INSERT INTO document_chunks (document_id, position, chunk, embedding)
+                SELECT :document_id, i, 'chunk ' || i, (SELECT array_agg(random() - 0.5)::vector FROM generate_series(1, :dim) WHERE i > 0)
+                FROM generate_series(1, :n_chunks) AS i
+            """),
+            {"document_id": document.id, "dim": EMBED_DIM, "n_chunks": N_CHUNKS},
+        )
+        conn.execute(text("ANALYZE document_chunks"))
+
+        yield uow
+
+        uow.session.rollback()
+
+def random_embeddings(n: int) -> list[np.ndarray]:
+    rng = np.random.default_rng(0)
+    return [rng.standard_normal(EMBED_DIM, dtype=np.float32) for _ in range(n)]
+
+def test_indexed_search_uses_hnsw_index(uow):
+    # at this size a seq scan is the cheaper plan, and how much cheaper depends on the dead rows left by earlier runs.
+    # with seq scans off this checks the query can use the index, benchmarks/similarity_plans.py that the planner picks it on its own.
+    uow.session.execute(text("SET LOCAL enable_seqscan = off"))
+    plan = uow.chunks.explain_similarities(random_embeddings(3), mode = SimilaritySearchMode.INDEXED)
+
+    assert any("Index Scan using ix_documents_embedding_hnsw_cos" in line for line in plan), "\n".join(plan)
+
+def test_indexed_search_matches_exact_search(uow):
+    embeddings = random_embeddings(3)
+
+    # ef_search above the row count makes the hnsw search exhaustive
+    indexed = uow.chunks.get_similarities(embeddings, limit = 10, mode = SimilaritySearchMode.INDEXED, ef_search = N_CHUNKS)
+    exact = uow.chunks.get_similarities(embeddings, limit = 10, mode = SimilaritySearchMode.EXACT)
+
+    assert [chunk.id for chunk, _ in indexed] == [chunk.id for chunk, _ in exact]
+    assert [similarity for _, similarity in indexed] == sorted(similarity for _, similarity in indexed)